@@ -8,6 +8,7 @@ from django.conf import settings
 bind = settings.GUNICORN_BIND
 workers = multiprocessing.cpu_count() * 2 + 1
 
+# The workers share the rate tables by mapping settings.RATE_BOOK_FILE (if set), see compile_rate_book
 preload_app = True
 
 chdir = settings.PROJECT_PATH
@@ -1,12 +1,16 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.utils.html import format_html, format_html_join
 from lc_calc.utils.related_field_admin import RelatedFieldAdmin
 
 from lc_calc.models import (LoanType,
                             LoanCompany,
                             LoanAdditionType,
                             LoanAddition,
+                            LoanAdditionTable,
                             LoanCalculation,
-                            LoanCompanyMessage)
+                            LoanCompanyMessage,
+                            rate_book)
 
 admin.site.register(LoanType)
 
@@ -22,6 +26,14 @@ class LoanCompanyMessageAdmin(admin.ModelAdmin):
 admin.site.register(LoanCompanyMessage, LoanCompanyMessageAdmin)
 
 
+class UntrackedChangeList(ChangeList):
+    """
+    A change list that does not track the changes of the (read only) instances it lists.
+    """
+    def get_queryset(self, request):
+        return super().get_queryset(request).untracked()
+
+
 class LoanCalculationAdmin(admin.ModelAdmin):
     list_display = ['id', 'created', 'loan_company', 'loan_type', 'loan_amount', 'monthly_term', 'rate', 'monthly_payment']
     list_filter = ['created', 'loan_company', 'loan_type', 'loan_amount']
@@ -30,15 +42,69 @@ class LoanCalculationAdmin(admin.ModelAdmin):
     def has_add_permission(self, request):
         return False
 
+    def get_changelist(self, request, **kwargs):
+        return UntrackedChangeList
+
 
 admin.site.register(LoanCalculation, LoanCalculationAdmin)
 
 
-class LoanAdditionTypeAdmin(admin.ModelAdmin):
-    list_display = ['loan_company', 'loan_type', 'name', 'value_index_method_name', 'sum_in_rate_calculation']
+class RateBookAdmin(admin.ModelAdmin):
+    """
+    An admin for the models that rate tables are compiled from. The views' changes are bumped in the rate book
+    again once their transactions have committed (see RateBook.after_commit).
+    """
+
+    def add_view(self, *args, **kwargs):
+        with rate_book.after_commit():
+            return super().add_view(*args, **kwargs)
+
+    def change_view(self, *args, **kwargs):
+        with rate_book.after_commit():
+            return super().change_view(*args, **kwargs)
+
+    def delete_view(self, *args, **kwargs):
+        with rate_book.after_commit():
+            return super().delete_view(*args, **kwargs)
+
+    def changelist_view(self, *args, **kwargs):
+        with rate_book.after_commit():
+            return super().changelist_view(*args, **kwargs)
+
+
+class LoanAdditionTypeAdmin(RateBookAdmin):
+    list_display = ['loan_company', 'loan_type', 'name', 'value_index_method_name', 'sum_in_rate_calculation',
+                    'table_problems']
     list_editable = ['value_index_method_name', 'sum_in_rate_calculation']
     list_filter = ['loan_company', 'loan_type', 'name', 'value_index_method_name', 'sum_in_rate_calculation']
     search_fields = ['name']
+    actions = ['pack_loan_additions', 'check_tables']
+
+    @staticmethod
+    def get_problems(obj):
+        return rate_book.get_table(obj.loan_company_id, obj.loan_type_id, obj.pk).validate()
+
+    def table_problems(self, obj):
+        problems = self.get_problems(obj)
+        if len(problems) > 2:
+            return '{} (and {} more)'.format('; '.join(problems[:2]), len(problems) - 2)
+        return '; '.join(problems)
+    table_problems.short_description = "Table problems"
+
+    def check_tables(self, request, queryset):
+        count = 0
+        for value_type in queryset:
+            for problem in self.get_problems(value_type):
+                self.message_user(request, '{}: {}'.format(value_type, problem), messages.WARNING)
+                count += 1
+        if not count:
+            self.message_user(request, 'No problems found')
+    check_tables.short_description = 'Check the tables for problems'
+
+    def pack_loan_additions(self, request, queryset):
+        packed = [value_type for value_type in queryset if LoanAdditionTable.pack_loan_additions(value_type)]
+        self.message_user(request, 'Packed the loan additions of {} types'.format(len(packed)))
+    pack_loan_additions.short_description = 'Pack the loan additions into tables'
 
 admin.site.register(LoanAdditionType, LoanAdditionTypeAdmin)
 
@@ -51,7 +117,7 @@ class LoanCompanyAdmin(admin.ModelAdmin):
 admin.site.register(LoanCompany, LoanCompanyAdmin)
 
 
-class LoanAdditionLookupAdmin(RelatedFieldAdmin):
+class LoanAdditionLookupAdmin(RelatedFieldAdmin, RateBookAdmin):
     list_display = ['id',
                     'loan_company_title',
                     'loan_type_name',
@@ -68,6 +134,39 @@ class LoanAdditionLookupAdmin(RelatedFieldAdmin):
                      'loan_type__name',
                      'value_type__name']
     list_editable = ['credit_score', 'value_index', 'value']
+    actions = ['delete_selected']
+
+    def changelist_view(self, request, extra_context=None):
+        # The list edits and the delete action change many rows at once: bump each of their tables once at the end
+        request.changed_value_type_ids = set()
+        try:
+            return super().changelist_view(request, extra_context)
+        finally:
+            for value_type in LoanAdditionType.objects.filter(pk__in=request.changed_value_type_ids):
+                value_type.rate_table_changed()
+
+    def rate_table_changed(self, request, value_type_ids):
+        if hasattr(request, 'changed_value_type_ids'):
+            request.changed_value_type_ids.update(value_type_ids)
+        else:
+            for value_type in LoanAdditionType.objects.filter(pk__in=value_type_ids):
+                value_type.rate_table_changed()
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self.rate_table_changed(request, [obj.value_type_id])
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        self.rate_table_changed(request, [obj.value_type_id])
+
+    def delete_selected(self, request, queryset):
+        value_type_ids = set(queryset.values_list('value_type', flat=True))
+        response = admin.actions.delete_selected(self, request, queryset)
+        if response is None:
+            self.rate_table_changed(request, value_type_ids)
+        return response
+    delete_selected.short_description = admin.actions.delete_selected.short_description
 
     def loan_company_title(self, obj):
         return obj.loan_company.title
@@ -86,4 +185,48 @@ class LoanAdditionLookupAdmin(RelatedFieldAdmin):
 
 
 
-admin.site.register(LoanAddition, LoanAdditionLookupAdmin)
\ No newline at end of file
+admin.site.register(LoanAddition, LoanAdditionLookupAdmin)
+
+
+class LoanAdditionTableAdmin(RateBookAdmin):
+    list_display = ['loan_company', 'loan_type', 'value_type', 'size']
+    list_filter = ['loan_company', 'loan_type']
+    search_fields = ['loan_company__title',
+                     'loan_type__name',
+                     'value_type__name']
+    fields = ['loan_company', 'loan_type', 'value_type', 'problems', 'grid']
+    readonly_fields = fields
+    actions = ['unpack']
+
+    def has_add_permission(self, request):
+        return False
+
+    def size(self, obj):
+        rate_table = obj.get_rate_table()
+        return '{} x {}'.format(len(rate_table.credit_scores), len(rate_table.value_indices))
+    size.short_description = "Credit scores x value indices"
+
+    def problems(self, obj):
+        return format_html_join('', '<p>{0}</p>', ((problem,) for problem in obj.get_rate_table().validate()))
+    problems.short_description = "Problems"
+
+    def grid(self, obj):
+        rate_table = obj.get_rate_table()
+        header = format_html_join('', '<th>{0}</th>', (('{:g}'.format(value_index),)
+                                                       for value_index in rate_table.value_indices))
+        rows = format_html_join('', '<tr><th>{0}</th>{1}</tr>', (
+            ('{:g}'.format(credit_score),
+             format_html_join('', '<td>{0}</td>', ((value if value == value else '',) for value in values)))
+            for (credit_score, values) in zip(rate_table.credit_scores, rate_table.values)))
+        return format_html('<table><tr><th></th>{0}</tr>{1}</table>', header, rows)
+    grid.short_description = "Values (credit score rows, value index columns)"
+
+    def unpack(self, request, queryset):
+        count = 0
+        for packed in queryset:
+            packed.unpack()
+            count += 1
+        self.message_user(request, 'Unpacked {} tables into loan additions'.format(count))
+    unpack.short_description = 'Unpack into loan additions (to edit them)'
+
+admin.site.register(LoanAdditionTable, LoanAdditionTableAdmin)
\ No newline at end of file
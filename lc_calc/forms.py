@@ -3,7 +3,8 @@ from django.forms.util import ErrorList
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
-from lc_calc.models import LoanCalculation, LoanCompany, LoanType
+from lc_calc.models import LoanCalculation, LoanCompany, get_loan_type_choices
+from lc_calc.quotes import COMPARISON_ORDERINGS
 
 
 class PercentInput(forms.TextInput):
@@ -74,6 +75,7 @@ class LoanCalculationForm(forms.ModelForm):
 
         result = super().__init__(
             data, files, auto_id, prefix, initial, error_class, label_suffix, empty_permitted, instance)
+        self.loan_company = loan_company
 
         # Set the loan_type choices based on the company
         self.fields['loan_type'].widget.choices = self.get_loan_type_choices(loan_company)
@@ -93,7 +95,7 @@ class LoanCalculationForm(forms.ModelForm):
 
     @staticmethod
     def get_loan_type_choices(loan_company):
-        return [(lt.id, lt.name) for lt in LoanType.objects.filter(loanaddition__loan_company=loan_company).distinct()]
+        return get_loan_type_choices(loan_company.pk)
 
     def clean(self):
         """
@@ -128,7 +130,29 @@ class LoanCalculationForm(forms.ModelForm):
         return cleaned_data
 
     def save(self, commit=True):
-        loan_company = LoanCompany.objects.get(pk=self.cleaned_data.get('loan_company_id'))
-        self.instance.loan_company = loan_company
+        loan_company_id = self.cleaned_data.get('loan_company_id')
+        if self.loan_company.pk != loan_company_id:
+            self.loan_company = LoanCompany.objects.get(pk=loan_company_id)
+        self.instance.loan_company = self.loan_company
         return super().save(commit)
 
+
+
+class LoanComparisonForm(forms.ModelForm):
+    """
+    The applicant profile quoted at every loan company by the comparison.
+    """
+    order_by = forms.ChoiceField(choices=[(name, name.replace('_', ' ').capitalize())
+                                          for name in COMPARISON_ORDERINGS],
+                                 required=False)
+
+    class Meta:
+        model = LoanCalculation
+        fields = ['loan_type',
+                  'loan_amount',
+                  'monthly_term',
+                  'estimated_credit_score',
+                  'estimated_collateral_value',
+                  'estimated_monthly_income',
+                  'estimated_monthly_expenses',
+                  'estimated_year_of_collateral']
@@ -1,13 +1,83 @@
 """
 Import a csv file containing loan data into the db.
 """
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import csv
-from lc_calc.models import LoanCompany, LoanType, LoanAdditionType, LoanAddition
+import hashlib
+import time
+
+from django.db import transaction
+
+from lc_calc.models import (LoanCompany,
+                            LoanType,
+                            LoanAdditionType,
+                            LoanAddition,
+                            LoanAdditionChecksum,
+                            LoanAdditionTable,
+                            rate_book)
+from lc_calc.utils.rate_table import RateTable
+
+
+class LoanDataTable(namedtuple('LoanDataTable', ['loan_company_title',
+                                                 'loan_type_name',
+                                                 'value_type_name',
+                                                 'value_indices',
+                                                 'rows'])):
+    """
+    One table block of the csv: the value_index header row and the (credit_score, values) rows that follow it.
+    """
+    @property
+    def key(self):
+        return (self.loan_company_title, self.loan_type_name, self.value_type_name)
+
+    @property
+    def fingerprint(self):
+        """
+        A checksum of the value indices and values, as stored in LoanAdditionChecksum.
+        """
+        value_indices = [value_index for (_, value_index) in self.value_indices]
+        return hashlib.sha1(repr((value_indices, self.rows)).encode('utf-8')).hexdigest()
+
+    def get_cells(self):
+        """
+        The (credit_score, value_index, value) cells of the table.
+        """
+        return [(credit_score, value_index, value)
+                for (credit_score, values) in self.rows
+                for ((_, value_index), value) in zip(self.value_indices, values)]
+
+
+class LoanDataImportError(Exception):
+    """
+    The csv file could not be imported.
+    """
 
 
 class LoanDataImporter(object):
+    """
+    Imports the tables in a csv file.
+    By default each cell is saved as it is read. In bulk mode each table is parsed first and then replaced
+    in one transaction with a single delete and bulk insert, so the quotes never see a half imported table.
+    Incremental mode is bulk mode that skips the tables whose fingerprint matches the stored checksum.
+    Packed mode is bulk mode that stores each table as a LoanAdditionTable rather than LoanAddition rows.
+    import_files() imports several files at once in bulk mode, parsing them in parallel.
+    """
     value_keys = ['vi{0}'.format(i) for i in range(1, 51)]
     value_indices = None
+    value_type = None
+
+    def __init__(self, bulk=False, incremental=False, packed=False):
+        self.bulk = bulk or incremental or packed
+        self.incremental = incremental
+        self.packed = packed
+        self.files_imported = 0
+        self.rows_imported = 0
+        self.tables_imported = 0
+        self.tables_skipped = 0
+        self.changed_tables = []
+        self.seconds = 0.0
 
     @staticmethod
     def get_or_create(model_class, **kwargs):
@@ -18,9 +88,67 @@ class LoanDataImporter(object):
             obj.save()
             return obj
 
+    def get_value_indices(self, row):
+        value_indices = list()
+        for k in self.value_keys:
+            try:
+                value_indices.append((k, int(row[k])))
+            except (ValueError, KeyError):
+                # Either no more values for this particular table or no more columns in this csv
+                break
+        return value_indices
+
     def import_file(self, csv_file):
-        for row in csv.DictReader(csv_file):
+        start = time.time()
+        if self.bulk:
+            for table in self.parse_tables(csv_file):
+                self.import_table(table)
+        else:
+            try:
+                self.import_rows(csv_file)
+            finally:
+                self.table_changed()
+        self.files_imported += 1
+        self.seconds += time.time() - start
+
+    def import_files(self, csv_filenames, processes=None):
+        """
+        Parse and check the csv files in a pool of processes, then import their tables in this one, a
+        (loan company, loan type) at a time and in file order within each. A file with an error is not
+        imported at all. Returns a dictionary of the errors keyed on the filename.
+        """
+        start = time.time()
+        tables = OrderedDict()
+        errors = {}
+        with ProcessPoolExecutor(processes) as executor:
+            for (csv_filename, file_tables, error) in executor.map(partial(parse_file, type(self)), csv_filenames):
+                if error is not None:
+                    errors[csv_filename] = error
+                    continue
+                self.files_imported += 1
+                for table in file_tables:
+                    tables.setdefault(table.key[:2], []).append(table)
+
+        for loan_tables in tables.values():
+            for table in loan_tables:
+                self.import_table(table)
+        self.seconds += time.time() - start
+        return errors
+
+    def table_changed(self):
+        """
+        Once the rows of the current table have been saved, bump the rate book and forget the table's checksum.
+        """
+        if self.value_type is not None:
+            self.value_type.rate_table_changed()
+            self.value_type = None
+
+    def import_rows(self, csv_file):
+        reader = csv.DictReader(csv_file)
+        for row in reader:
             if row['Type'] == 'value_index':
+                self.table_changed()
+
                 # Set the reference data and current indices
                 self.loan_company = self.get_or_create(LoanCompany, title=row['LoanCompany_title'])
                 self.loan_type = self.get_or_create(LoanType, name=row['LoanType_name'])
@@ -29,21 +157,12 @@ class LoanDataImporter(object):
                                                      loan_company=self.loan_company,
                                                      loan_type=self.loan_type)
 
-                value_indices = list()
-                for k in self.value_keys:
-                    try:
-                        value_indices.append((k, int(row[k])))
-                    except (ValueError, KeyError):
-                        # Either no more values for this particular table or no more columns in this csv
-                        break
-
-                self.value_indices = value_indices
+                self.value_indices = self.get_value_indices(row)
+                self.tables_imported += 1
 
                 # Delete old values
-                for vo in LoanAddition.objects.filter(loan_company=self.loan_company,
-                                                      loan_type=self.loan_type,
-                                                      value_type=self.value_type,):
-                    vo.delete()
+                LoanAdditionTable.objects.filter(value_type=self.value_type).delete()
+                LoanAddition.delete_table(self.value_type.pk)
 
             elif row['Type'] == 'values':
 
@@ -57,8 +176,98 @@ class LoanDataImporter(object):
                         value_index=value_index,
                         value=float(row[value_index_key]))
                     loan_lookup_value.save()
+                    self.rows_imported += 1
+            else:
+                raise LoanDataImportError('Line {}: unknown Type {!r}'.format(reader.line_num, row['Type']))
+
+    def parse_tables(self, csv_file):
+        """
+        Generate a LoanDataTable for each table block in the csv file, checking the values as they are read.
+        """
+        table = None
+        reader = csv.DictReader(csv_file)
+        for row in reader:
+            if row['Type'] == 'value_index':
+                if table is not None:
+                    yield table
+                table = LoanDataTable(row['LoanCompany_title'],
+                                      row['LoanType_name'],
+                                      row['LoanAdditionLookupValueType'],
+                                      self.get_value_indices(row),
+                                      [])
+            elif row['Type'] == 'values':
+                if table is None:
+                    raise LoanDataImportError('Line {}: values before any value_index row'.format(reader.line_num))
+                try:
+                    table.rows.append((int(row['credit_score']),
+                                       [float(row[value_index_key]) for (value_index_key, _) in table.value_indices]))
+                except (ValueError, TypeError) as e:
+                    raise LoanDataImportError('Line {}: {}'.format(reader.line_num, e))
+            else:
+                raise LoanDataImportError('Line {}: unknown Type {!r}'.format(reader.line_num, row['Type']))
+        if table is not None:
+            yield table
+
+    def import_table(self, table):
+        """
+        Replace the values of a table in a single transaction (unless it is unchanged in incremental mode).
+        """
+        fingerprint = table.fingerprint
+        with transaction.atomic():
+            loan_company = self.get_or_create(LoanCompany, title=table.loan_company_title)
+            loan_type = self.get_or_create(LoanType, name=table.loan_type_name)
+            value_type = self.get_or_create(LoanAdditionType,
+                                            name=table.value_type_name,
+                                            loan_company=loan_company,
+                                            loan_type=loan_type)
+
+            checksums = LoanAdditionChecksum.objects.filter(value_type=value_type)
+            if self.incremental and checksums.filter(checksum=fingerprint).exists():
+                self.tables_skipped += 1
+                return
+
+            LoanAddition.delete_table(value_type.pk)
+            LoanAdditionTable.objects.filter(value_type=value_type).delete()
+            if self.packed:
+                LoanAdditionTable.pack(value_type, RateTable.from_rows(table.get_cells())).save()
             else:
-                import IPython; IPython.embed()
+                LoanAddition.objects.bulk_create([LoanAddition(loan_company=loan_company,
+                                                               loan_type=loan_type,
+                                                               value_type=value_type,
+                                                               credit_score=credit_score,
+                                                               value_index=value_index,
+                                                               value=value)
+                                                  for (credit_score, value_index, value) in table.get_cells()])
+            checksums.delete()
+            LoanAdditionChecksum.objects.create(value_type=value_type, checksum=fingerprint)
+
+        # bulk_create skips the signals that keep the rate tables up to date
+        rate_book.bump(loan_company.pk, loan_type.pk)
+        self.tables_imported += 1
+        self.rows_imported += len(table.rows) * len(table.value_indices)
+        self.changed_tables.append(table.key)
+
+    def report(self):
+        rate = self.rows_imported / self.seconds if self.seconds else 0.0
+        lines = ['Imported {} values in {} tables from {} files in {:.2f}s ({:.0f} values/second)'.format(
+            self.rows_imported, self.tables_imported, self.files_imported, self.seconds, rate)]
+        if self.incremental:
+            lines.append('Skipped {} unchanged tables'.format(self.tables_skipped))
+            lines.extend('Changed: {} / {} / {}'.format(*key) for key in self.changed_tables)
+        return '\n'.join(lines)
+
+
+def parse_file(importer_class, csv_filename):
+    """
+    Parse a csv file for LoanDataImporter.import_files (in a worker process).
+    Returns (csv_filename, tables, error) with error None if the file is good.
+    No queries are made here, as the worker shares the database connection it was forked with.
+    """
+    try:
+        with open(csv_filename, 'rt') as csv_file:
+            return csv_filename, list(importer_class().parse_tables(csv_file)), None
+    except (LoanDataImportError, csv.Error, KeyError) as e:
+        return csv_filename, [], 'Cannot parse: {}'.format(e)
 
 
 def process_command_line(importer_class):
@@ -71,6 +280,16 @@ def process_command_line(importer_class):
     parser = argparse.ArgumentParser(description="Import any asset CSV file into adaptwater from the command line.",
                                      epilog="Trying a dry run first is highly recommended")
     parser.add_argument('csv_file_or_folder', help='the csv file or folder of files to be imported')
+    parser.add_argument('--bulk', action='store_true',
+                        help='replace each table in one transaction with a bulk insert')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only replace the tables that have changed since they were last imported (implies --bulk)')
+    parser.add_argument('--packed', action='store_true',
+                        help='store each table packed into a single row (implies --bulk)')
+    parser.add_argument('--parallel', action='store_true',
+                        help='parse the files in parallel before importing them (implies --bulk)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='the number of processes parsing the files in parallel (defaults to the number of cpus)')
     args = parser.parse_args()
 
     def is_csv(fname):
@@ -88,10 +307,19 @@ def process_command_line(importer_class):
         csv_filenames = []
 
     # import each csv file
-    importer = importer_class()
-    for csv_filename in csv_filenames:
-        with open(csv_filename, 'rt') as csv_file:
-            importer.import_file(csv_file)
+    importer = importer_class(bulk=args.bulk, incremental=args.incremental, packed=args.packed)
+    if args.parallel:
+        errors = importer.import_files(csv_filenames, args.processes)
+        for csv_filename in sorted(errors):
+            print('{}: {}'.format(csv_filename, errors[csv_filename]))
+    else:
+        for csv_filename in csv_filenames:
+            with open(csv_filename, 'rt') as csv_file:
+                try:
+                    importer.import_file(csv_file)
+                except LoanDataImportError as e:
+                    print('{}: {}'.format(csv_filename, e))
+    print(importer.report())
 
 if __name__ == "__main__":
-    process_command_line(LoanDataImporter)
\ No newline at end of file
+    process_command_line(LoanDataImporter)
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from lc_calc.models import LoanAdditionType, rate_book
+
+
+class Command(BaseCommand):
+    help = 'Compile the rate tables of every loan company and loan type into settings.RATE_BOOK_FILE'
+
+    def handle(self, *args, **options):
+        if not settings.RATE_BOOK_FILE:
+            raise CommandError('RATE_BOOK_FILE is not set')
+        keys = list(LoanAdditionType.objects.order_by().values_list('loan_company_id', 'loan_type_id').distinct())
+        rate_book.write_file(keys)
+        for value_type in LoanAdditionType.objects.select_related('loan_company', 'loan_type'):
+            for problem in rate_book.get_table(value_type.loan_company_id, value_type.loan_type_id,
+                                               value_type.pk).validate():
+                self.stderr.write('{} {}: {}'.format(value_type.loan_type, value_type, problem))
+        self.stdout.write('Compiled {} rate tables into {}'.format(len(keys), settings.RATE_BOOK_FILE))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from lc_calc.models import calculation_spool
+
+
+class Command(BaseCommand):
+    help = 'Save the LoanCalculation records waiting in the write-behind spool'
+
+    def handle(self, *args, **options):
+        if calculation_spool is None:
+            raise CommandError('There is no LOAN_CALCULATION_SPOOL')
+        self.stdout.write('Saved {} calculations'.format(calculation_spool.flush_all()))
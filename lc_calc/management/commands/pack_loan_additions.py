@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from lc_calc.models import LoanAdditionType, LoanAdditionTable
+
+
+class Command(BaseCommand):
+    help = 'Pack the LoanAddition rows of each value type into a LoanAdditionTable (or unpack them again)'
+    option_list = BaseCommand.option_list + (
+        make_option('--unpack', action='store_true', dest='unpack', default=False,
+                    help='Replace the packed tables with LoanAddition rows'),)
+
+    def handle(self, *args, **options):
+        count = 0
+        if options['unpack']:
+            for packed in LoanAdditionTable.objects.all():
+                packed.unpack()
+                count += 1
+            self.stdout.write('Unpacked {} tables'.format(count))
+        else:
+            for value_type in LoanAdditionType.objects.all():
+                if LoanAdditionTable.pack_loan_additions(value_type) is not None:
+                    count += 1
+            self.stdout.write('Packed {} tables'.format(count))
@@ -0,0 +1,9 @@
+from lc_calc.models import rate_book
+
+
+class RateBookMiddleware(object):
+    """
+    Brings the per process rate book up to date with changes made by other processes, once per request.
+    """
+    def process_request(self, request):
+        rate_book.sync()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'LoanAdditionTable'
+        db.create_table('lc_calc_loanadditiontable', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('loan_company', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['lc_calc.LoanCompany'])),
+            ('loan_type', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['lc_calc.LoanType'])),
+            ('value_type', self.gf('django.db.models.fields.related.OneToOneField')(unique=True, to=orm['lc_calc.LoanAdditionType'])),
+            ('credit_scores', self.gf('django.db.models.fields.BinaryField')()),
+            ('value_indices', self.gf('django.db.models.fields.BinaryField')()),
+            ('values', self.gf('django.db.models.fields.BinaryField')()),
+        ))
+        db.send_create_signal('lc_calc', ['LoanAdditionTable'])
+
+        # Adding model 'LoanAdditionChecksum'
+        db.create_table('lc_calc_loanadditionchecksum', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('value_type', self.gf('django.db.models.fields.related.OneToOneField')(unique=True, to=orm['lc_calc.LoanAdditionType'])),
+            ('checksum', self.gf('django.db.models.fields.CharField')(max_length=40)),
+        ))
+        db.send_create_signal('lc_calc', ['LoanAdditionChecksum'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'LoanAdditionTable'
+        db.delete_table('lc_calc_loanadditiontable')
+
+        # Deleting model 'LoanAdditionChecksum'
+        db.delete_table('lc_calc_loanadditionchecksum')
+
+
+    models = {
+        'lc_calc.loanaddition': {
+            'Meta': {'ordering': "['loan_company__title', 'loan_type__name', 'value_type__name', 'credit_score', 'value_index']", 'object_name': 'LoanAddition'},
+            'credit_score': ('django.db.models.fields.IntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'loan_company': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lc_calc.LoanCompany']"}),
+            'loan_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lc_calc.LoanType']"}),
+            'value': ('django.db.models.fields.FloatField', [], {}),
+            'value_index': ('django.db.models.fields.IntegerField', [], {}),
+            'value_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lc_calc.LoanAdditionType']"})
+        },
+        'lc_calc.loanadditionchecksum': {
+            'Meta': {'object_name': 'LoanAdditionChecksum'},
+            'checksum': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'value_type': ('django.db.models.fields.related.OneToOneField', [], {'unique': 'True', 'to': "orm['lc_calc.LoanAdditionType']"})
+        },
+        'lc_calc.loanadditiontable': {
+            'Meta': {'ordering': "['loan_company__title', 'loan_type__name', 'value_type__name']", 'object_name': 'LoanAdditionTable'},
+            'credit_scores': ('django.db.models.fields.BinaryField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'loan_company': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lc_calc.LoanCompany']"}),
+            'loan_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lc_calc.LoanType']"}),
+            'value_indices': ('django.db.models.fields.BinaryField', [], {}),
+            'value_type': ('django.db.models.fields.related.OneToOneField', [], {'unique': 'True', 'to': "orm['lc_calc.LoanAdditionType']"}),
+            'values': ('django.db.models.fields.BinaryField', [], {})
+        },
+        'lc_calc.loanadditiontype': {
+            'Meta': {'object_name': 'LoanAdditionType'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'loan_company': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lc_calc.LoanCompany']"}),
+            'loan_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lc_calc.LoanType']"}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'sum_in_rate_calculation': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'value_index_method_name': ('django.db.models.fields.CharField', [], {'max_length': '128', 'default': "'_get_value_index_loan_to_value'"})
+        },
+        'lc_calc.loancalculation': {
+            'Meta': {'object_name': 'LoanCalculation'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'current_loan_balance': ('lc_calc.models.CurrencyField', [], {'null': 'True', 'blank': 'True', 'max_digits': '10', 'decimal_places': '2'}),
+            'current_loan_estimated_remaining_term': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'current_loan_monthly_payment': ('lc_calc.models.CurrencyField', [], {'null': 'True', 'blank': 'True', 'max_digits': '10', 'decimal_places': '2'}),
+            'current_loan_rate': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'estimated_collateral_value': ('lc_calc.models.CurrencyField', [], {'null': 'True', 'blank': 'True', 'default': '1000.0', 'max_digits': '10', 'decimal_places': '2'}),
+            'estimated_credit_score': ('django.db.models.fields.IntegerField', [], {'blank': 'True', 'default': '850'}),
+            'estimated_monthly_expenses': ('lc_calc.models.CurrencyField', [], {'null': 'True', 'blank': 'True', 'default': '1000.0', 'max_digits': '10', 'decimal_places': '2'}),
+            'estimated_monthly_income': ('lc_calc.models.CurrencyField', [], {'null': 'True', 'blank': 'True', 'default': '5000.0', 'max_digits': '10', 'decimal_places': '2'}),
+            'estimated_year_of_collateral': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True', 'default': '2026'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'loan_amount': ('lc_calc.models.CurrencyField', [], {'max_digits': '10', 'decimal_places': '2'}),
+            'loan_company': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lc_calc.LoanCompany']"}),
+            'loan_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lc_calc.LoanType']"}),
+            'maximum_term': ('django.db.models.fields.IntegerField', [], {}),
+            'monthly_payment': ('lc_calc.models.CurrencyField', [], {'max_digits': '10', 'decimal_places': '2'}),
+            'monthly_term': ('django.db.models.fields.IntegerField', [], {'default': '60'}),
+            'rate': ('django.db.models.fields.FloatField', [], {}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'null': 'True'})
+        },
+        'lc_calc.loancompany': {
+            'Meta': {'ordering': "['title']", 'object_name': 'LoanCompany'},
+            'content': ('mezzanine.core.fields.RichTextField', [], {}),
+            'disclosure': ('mezzanine.core.fields.RichTextField', [], {'default': "'\\n<p>Our financial calculator tool will help you analyze your financial needs.\\nThe results are based on our quantitative underwriting criteria and accuracy of the inputted data.\\nThough we strive to provide you with the most accurate results possible, actual results will be\\ndependent upon our full underwriting requirements by a qualified loan officer.\\nThe calculations on this page do not assume that the company accepts any fiduciary duties.\\nThe calculations provided should not be taken as financial, legal or tax advice.\\nOur underwriting criteria is subject to change without notice.</p>\\n'"}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'logo': ('django.db.models.fields.files.ImageField', [], {'null': 'True', 'blank': 'True', 'max_length': '100'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sites.Site']"}),
+            'slug': ('django.db.models.fields.CharField', [], {'null': 'True', 'blank': 'True', 'max_length': '2000'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '500'})
+        },
+        'lc_calc.loancompanymessage': {
+            'Meta': {'object_name': 'LoanCompanyMessage'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'loan_calculation': ('django.db.models.fields.related.ForeignKey', [], {'null': 'True', 'to': "orm['lc_calc.LoanCalculation']"}),
+            'loan_company': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lc_calc.LoanCompany']"}),
+            'message': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True', 'max_length': '1024'}),
+            'sender': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'null': 'True'})
+        },
+        'lc_calc.loantype': {
+            'Meta': {'ordering': "['name']", 'object_name': 'LoanType'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '64', 'unique': 'True'})
+        },
+        'sites.site': {
+            'Meta': {'db_table': "'django_site'", 'ordering': "('domain',)", 'object_name': 'Site'},
+            'domain': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        }
+    }
+
+    complete_apps = ['lc_calc']
\ No newline at end of file
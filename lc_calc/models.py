@@ -1,23 +1,34 @@
-from decimal import Decimal
 import datetime
+import hashlib
+import threading
+import time
 
+import numpy as np
 from django.conf import settings
-from django.db import models
-from django.db.models import Max
+from django.core.cache import cache
+from django.db import connection, models, transaction, DEFAULT_DB_ALIAS
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import six, timezone
 
 from mezzanine.core.models import Slugged, RichText, TimeStamped
 from mezzanine.core.fields import RichTextField
 
-from lc_calc.utils.excel_functions import nper, pmt
+from lc_calc.utils.excel_functions import nper, pmt, rate as solve_rate
+from lc_calc.utils.amortization import amortization_schedule
 from lc_calc.utils.email import send_email
+from lc_calc.utils.money import Money, MoneyJSONEncoder
+from lc_calc.utils.rate_table import RateBook, RateTable, PricingPlan
+from lc_calc.utils.spool import Spool
 
 
-class CurrencyField(models.DecimalField):
+class CurrencyField(six.with_metaclass(models.SubfieldBase, models.DecimalField)):
     """
     Currency as a number with two decimal places (from
     http://stackoverflow.com/questions/2013835/django-how-should-i-store-a-money-value)
+    The values are Money (whole cents), stored as decimals.
     """
-    __metaclass__ = models.SubfieldBase
 
     def __init__(self, verbose_name=None, name=None, **kwargs):
         decimal_places = kwargs.pop('decimal_places', 2)
@@ -28,43 +39,78 @@ class CurrencyField(models.DecimalField):
             decimal_places=decimal_places, **kwargs)
 
     def to_python(self, value):
-        try:
-            return super(CurrencyField, self).to_python(value).quantize(Decimal("0.01"))
-        except AttributeError:
-            return None
+        if value is None or isinstance(value, (Money, float)):
+            return Money.from_value(value)
+        return Money.from_value(super(CurrencyField, self).to_python(value))
+
+    def get_prep_value(self, value):
+        value = self.to_python(value)
+        return None if value is None else value.to_decimal()
+
+    def get_db_prep_save(self, value, connection):
+        return connection.ops.value_to_db_decimal(self.get_prep_value(value), self.max_digits, self.decimal_places)
+
+
+# See http://south.aeracode.org/docs/customfields.html
+if "south" in settings.INSTALLED_APPS:
+    try:
+        from south.modelsinspector import add_introspection_rules
+        add_introspection_rules(patterns=[r"^lc_calc\.models\.CurrencyField"], rules=[])
+    except ImportError:
+        pass
+
+
+# Whether the model instances being made should track their changes (see ModelDiffQuerySet.untracked)
+_tracking = threading.local()
+# The value of a field that has not been loaded
+DEFERRED = object()
 
 
 class ModelDiffMixin(object):
     """
     A model mixin that tracks model fields' values and provides some methods
     to determine what fields have been changed.
+
+    The initial state is a shallow copy of the instance's attributes, taken as it is made (or saved), so
+    nothing is converted or compared until a diff is asked for. Deferred fields are not tracked. Instances
+    loaded through an untracked() queryset keep no initial state and count as changed in every field.
     """
 
     def __init__(self, *args, **kwargs):
         super(ModelDiffMixin, self).__init__(*args, **kwargs)
-        self._initial = self._dict
+        self._initial = self._snapshot() if getattr(_tracking, 'enabled', True) else None
 
-    @property
-    def _dict(self):
+    def _snapshot(self):
+        initial = self.__dict__.copy()
+        initial.pop('_initial', None)
+        return initial
+
+    def _changed(self):
         """
-        Return the basic fields (no relations) and their values as a dictionary.
+        Generate the (field, initial value, value) of each changed field.
         """
-        return {field.name: field.value_from_object(self) for field in self._meta.fields}
+        initial = self._initial
+        current = self.__dict__
+        for field in self._meta.fields:
+            value = current.get(field.attname, DEFERRED)
+            if initial is None:
+                yield field, None, value
+            else:
+                initial_value = initial.get(field.attname, DEFERRED)
+                if initial_value is not DEFERRED and initial_value != value:
+                    yield field, initial_value, value
 
     @property
     def diff(self):
-        d1 = self._initial
-        d2 = self._dict
-        diffs = [(k, (v, d2[k])) for k, v in d1.items() if v != d2[k]]
-        return dict(diffs)
+        return {field.name: (initial_value, value) for (field, initial_value, value) in self._changed()}
 
     @property
     def has_changed(self):
-        return bool(self.diff)
+        return next(self._changed(), None) is not None
 
     @property
     def changed_fields(self):
-        return self.diff.keys()
+        return [field.name for (field, _, _) in self._changed()]
 
     def get_field_diff(self, field_name):
         """
@@ -78,7 +124,51 @@ class ModelDiffMixin(object):
         """
         if self.has_changed:
             super(ModelDiffMixin, self).save(*args, **kwargs)
-            self._initial = self._dict
+            self._initial = self._snapshot()
+
+
+class ModelDiffQuerySet(QuerySet):
+    """
+    A queryset of ModelDiffMixin models that can skip the change tracking of the instances it loads.
+    """
+    tracked = True
+
+    def untracked(self):
+        """
+        Load the instances without tracking their changes (for reading many of them).
+        """
+        return self._clone(tracked=False)
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('tracked', self.tracked)
+        return super(ModelDiffQuerySet, self)._clone(*args, **kwargs)
+
+    def iterator(self):
+        if self.tracked:
+            return super(ModelDiffQuerySet, self).iterator()
+        return self._untracked_iterator()
+
+    def _untracked_iterator(self):
+        instances = super(ModelDiffQuerySet, self).iterator()
+        while True:
+            # Only untracked while this queryset is making them, as the consumer may make others in between
+            _tracking.enabled = False
+            try:
+                instance = next(instances)
+            except StopIteration:
+                return
+            finally:
+                _tracking.enabled = True
+            yield instance
+
+
+class ModelDiffManager(models.Manager):
+
+    def get_queryset(self):
+        return ModelDiffQuerySet(self.model, using=self._db)
+
+    def untracked(self):
+        return self.get_queryset().untracked()
 
 
 class Named(models.Model):
@@ -94,7 +184,7 @@ class Named(models.Model):
 
 
 class LoanType(Named):
-    pass
+    generation_key = 'lc_calc.loan_type.generation'
 
 DISCLOSURE_DEFAULT = """
 <p>Our financial calculator tool will help you analyze your financial needs.
@@ -115,10 +205,41 @@ class LoanCompany(Slugged, RichText):
                              help_text='The logo image for the company (need to set a size - keep it small)')
     email = models.EmailField(help_text='This email will be used for reporting and communication so it is essential.')
     disclosure = RichTextField("Disclosure", default=DISCLOSURE_DEFAULT)
+    generation_key = 'lc_calc.loan_company.generation'
 
     class Meta:
         ordering = ['title']
 
+    @classmethod
+    def get_by_slug(cls, slug):
+        """
+        Return the loan company with the slug, from the cache if it is there (DoesNotExist if there is none).
+        Any change to a loan company starts a new generation of cache keys, so the cache is never stale.
+        """
+        key = 'lc_calc.loan_company.{}.{}'.format(cache.get(cls.generation_key, 0), slug)
+        loan_company = cache.get(key)
+        if loan_company is None:
+            loan_company = cls.objects.get(slug=slug)
+            cache.set(key, loan_company)
+        return loan_company
+
+
+def bump_generation(key):
+    """
+    Change a cached generation number, so that the keys made with it are no longer used.
+    """
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Not there (or evicted), so start again from a value no process can have seen
+        cache.set(key, int(time.time() * 1000000), None)
+
+
+@receiver(post_save, sender=LoanCompany)
+@receiver(post_delete, sender=LoanCompany)
+def forget_loan_companies(sender, instance, **kwargs):
+    bump_generation(LoanCompany.generation_key)
+
 
 class LoanAdditionType(models.Model):
     """
@@ -151,6 +272,14 @@ class LoanAdditionType(models.Model):
                 self.sum_in_rate_calculation = False
         super().save(force_insert, force_update, using, update_fields)
 
+    def rate_table_changed(self):
+        """
+        Bump the rate book and forget the import checksum once the LoanAddition rows of this type have been changed.
+        The rows send no signals for this, so that changing a table costs the same however many rows it has.
+        """
+        LoanAdditionChecksum.objects.filter(value_type=self).delete()
+        rate_book.bump(self.loan_company_id, self.loan_type_id)
+
 
 class LoanAddition(models.Model):
     """
@@ -178,6 +307,186 @@ class LoanAddition(models.Model):
                                                       self.credit_score,
                                                       self.value)
 
+    @staticmethod
+    def delete_table(value_type_id):
+        """
+        Delete the rows of a value type with a single DELETE, without loading them or sending signals.
+        QuerySet.delete() cannot do this here, as Mezzanine listens to the post_delete of every model. It is safe
+        because nothing refers to LoanAddition and the rows have no receivers of their own: the caller bumps the
+        rate book and forgets the checksum once for the table (LoanAdditionType.rate_table_changed).
+        """
+        LoanAddition.objects.filter(value_type_id=value_type_id)._raw_delete(using=DEFAULT_DB_ALIAS)
+
+
+class LoanAdditionTable(models.Model):
+    """
+    A whole LoanAddition table packed into one row: the credit score axis, the value index axis and the
+    (credit scores x value indices) values as little endian doubles, NaN where the table has no cell.
+    Where a value type has one of these, it is used instead of its LoanAddition rows.
+    """
+    DTYPE = np.dtype('<f8')
+    loan_company = models.ForeignKey(LoanCompany)
+    loan_type = models.ForeignKey(LoanType)
+    value_type = models.OneToOneField(LoanAdditionType)
+    credit_scores = models.BinaryField()
+    value_indices = models.BinaryField()
+    values = models.BinaryField()
+
+    class Meta:
+        ordering = ['loan_company__title',
+                    'loan_type__name',
+                    'value_type__name']
+
+    def __str__(self):
+        return "{} | {} | {} |".format(self.loan_company, self.loan_type, self.value_type)
+
+    @classmethod
+    def pack(cls, value_type, rate_table):
+        """
+        Return an unsaved packed table of value_type holding a RateTable.
+        """
+        credit_scores, value_indices, values = rate_table.arrays
+        return cls(loan_company_id=value_type.loan_company_id,
+                   loan_type_id=value_type.loan_type_id,
+                   value_type=value_type,
+                   credit_scores=credit_scores.astype(cls.DTYPE).tobytes(),
+                   value_indices=value_indices.astype(cls.DTYPE).tobytes(),
+                   values=values.astype(cls.DTYPE).tobytes())
+
+    @classmethod
+    def pack_loan_additions(cls, value_type):
+        """
+        Replace the LoanAddition rows of value_type with a packed table, which is returned (None if there are no rows).
+        """
+        with rate_book.after_commit(), transaction.atomic():
+            additions = LoanAddition.objects.filter(value_type=value_type)
+            rate_table = RateTable.from_rows(additions.order_by('credit_score', 'value_index', 'id').values_list(
+                'credit_score', 'value_index', 'value'))
+            if not len(rate_table):
+                return None
+            cls.objects.filter(value_type=value_type).delete()
+            packed = cls.pack(value_type, rate_table)
+            packed.save()
+            # The save bumped the rate book and forgot the checksum
+            LoanAddition.delete_table(value_type.pk)
+        return packed
+
+    def unpack(self):
+        """
+        Replace the packed table with LoanAddition rows (so that they can be edited).
+        """
+        with rate_book.after_commit(), transaction.atomic():
+            LoanAddition.delete_table(self.value_type_id)
+            LoanAddition.objects.bulk_create([LoanAddition(loan_company_id=self.loan_company_id,
+                                                           loan_type_id=self.loan_type_id,
+                                                           value_type_id=self.value_type_id,
+                                                           credit_score=credit_score,
+                                                           value_index=value_index,
+                                                           value=value)
+                                              for (credit_score, value_index, value) in self.get_rows()])
+            self.delete()
+
+    def get_rate_table(self):
+        credit_scores = np.frombuffer(self.credit_scores, dtype=self.DTYPE)
+        value_indices = np.frombuffer(self.value_indices, dtype=self.DTYPE)
+        values = np.frombuffer(self.values, dtype=self.DTYPE).reshape(len(credit_scores), len(value_indices))
+        return RateTable.from_arrays(credit_scores, value_indices, values)
+
+    def get_rows(self):
+        """
+        The (credit_score, value_index, value) cells of the table, in table order.
+        """
+        rate_table = self.get_rate_table()
+        return [(int(credit_score), int(value_index), float(value))
+                for (credit_score, values) in zip(rate_table.credit_scores, rate_table.values)
+                for (value_index, value) in zip(rate_table.value_indices, values)
+                if value == value]
+
+
+def load_rate_tables(loan_company_id, loan_type_id):
+    """
+    Compile the rate tables for a loan company and loan type, from the packed tables where there are any
+    and from the LoanAddition rows of the other value types.
+    """
+    tables = {packed.value_type_id: packed.get_rate_table()
+              for packed in LoanAdditionTable.objects.filter(loan_company_id=loan_company_id,
+                                                             loan_type_id=loan_type_id)}
+    rows = LoanAddition.objects.filter(
+        loan_company_id=loan_company_id,
+        loan_type_id=loan_type_id).exclude(
+        value_type_id__in=list(tables)).order_by(
+        'credit_score', 'value_index', 'id').values_list(
+        'value_type_id', 'credit_score', 'value_index', 'value')
+    tables.update(rate_book.compile_rows(rows))
+    return tables
+
+def load_pricing_plan(loan_company_id, loan_type_id, tables, value_types=None):
+    """
+    Make the PricingPlan of a loan company and loan type from its rate tables, with the LoanCalculation value index
+    methods. The types are in id order, which fixes the order the rate is summed in (float sums depend on it).
+    """
+    if value_types is None:
+        value_types = LoanAdditionType.objects.filter(loan_company_id=loan_company_id,
+                                                      loan_type_id=loan_type_id).order_by('id')
+    value_index_functions = {name: getattr(LoanCalculation, name)
+                             for (name, _) in LoanAdditionType.VALUE_INDEX_METHOD_NAME_CHOICES}
+    return PricingPlan.from_value_types(list(value_types), tables, value_index_functions)
+
+rate_book = RateBook(load_rate_tables, cache, settings.RATE_BOOK_FILE, load_pricing_plan)
+
+
+@receiver(post_save, sender=LoanAdditionTable)
+@receiver(post_delete, sender=LoanAdditionTable)
+@receiver(post_save, sender=LoanAdditionType)
+@receiver(post_delete, sender=LoanAdditionType)
+def bump_rate_tables(sender, instance, **kwargs):
+    rate_book.bump(instance.loan_company_id, instance.loan_type_id)
+
+
+def get_loan_type_choices(loan_company_id):
+    """
+    The (id, name) of the loan types the loan company has rate tables for, in name order. They are cached until
+    the rate tables (of any loan company) or the loan types change.
+    """
+    generations = cache.get_many([rate_book.generation_key, LoanType.generation_key])
+    key = 'lc_calc.loan_type_choices.{}.{}.{}'.format(generations.get(rate_book.generation_key),
+                                                      generations.get(LoanType.generation_key),
+                                                      loan_company_id)
+    choices = cache.get(key)
+    if choices is None:
+        loan_type_ids = set(LoanAddition.objects.filter(loan_company_id=loan_company_id).values_list(
+            'loan_type_id', flat=True).distinct())
+        loan_type_ids.update(LoanAdditionTable.objects.filter(loan_company_id=loan_company_id).values_list(
+            'loan_type_id', flat=True))
+        choices = [(loan_type.id, loan_type.name) for loan_type in LoanType.objects.filter(id__in=loan_type_ids)]
+        cache.set(key, choices)
+    return choices
+
+
+@receiver(post_save, sender=LoanType)
+@receiver(post_delete, sender=LoanType)
+def forget_loan_type_choices(sender, instance, **kwargs):
+    bump_generation(LoanType.generation_key)
+
+
+class LoanAdditionChecksum(models.Model):
+    """
+    The fingerprint of the csv table block that a value type's additions were imported from, so that the importer
+    can skip tables that have not changed. Any other change to the additions deletes it (see
+    LoanAdditionType.rate_table_changed).
+    """
+    value_type = models.OneToOneField(LoanAdditionType)
+    checksum = models.CharField(max_length=40)
+
+    def __str__(self):
+        return "{} {}".format(self.value_type, self.checksum)
+
+
+@receiver(post_save, sender=LoanAdditionTable)
+@receiver(post_delete, sender=LoanAdditionTable)
+def forget_loan_addition_checksum(sender, instance, **kwargs):
+    LoanAdditionChecksum.objects.filter(value_type_id=instance.value_type_id).delete()
+
 
 class LoanCalculation(ModelDiffMixin, TimeStamped):
     """
@@ -202,6 +511,31 @@ class LoanCalculation(ModelDiffMixin, TimeStamped):
     maximum_term = models.IntegerField()
     rate = models.FloatField()  # calculated in save
     monthly_payment = CurrencyField()  # calculated in save
+    fingerprint = models.CharField(max_length=40, blank=True, editable=False, db_index=True)  # set in save
+
+    objects = ModelDiffManager()
+
+    # The fields each step of calculate() uses, so that only the steps affected by a change are redone.
+    # Every lookup also uses the credit score (and the pricing plan of the loan company and loan type).
+    CALCULATION_DEPENDENCIES = {
+        'current_loan_estimated_remaining_term': ('current_loan_balance',
+                                                  'current_loan_monthly_payment',
+                                                  'current_loan_rate'),
+        'monthly_payment': ('rate', 'monthly_term', 'loan_amount')}
+    VALUE_INDEX_DEPENDENCIES = {
+        '_get_value_index_loan_to_value': ('loan_amount', 'estimated_collateral_value'),
+        '_get_value_index_debt_to_income': ('estimated_monthly_expenses', 'estimated_monthly_income'),
+        '_get_value_index_year_of_collateral': ('estimated_year_of_collateral',)}
+    CALCULATION_INPUTS = ('estimated_credit_score',
+                          'current_loan_balance',
+                          'current_loan_monthly_payment',
+                          'current_loan_rate',
+                          'loan_amount',
+                          'monthly_term',
+                          'estimated_collateral_value',
+                          'estimated_monthly_income',
+                          'estimated_monthly_expenses',
+                          'estimated_year_of_collateral')
 
     def __str__(self):
         return "<{}: ${} / {}m>".format(self.id, self.loan_amount, self.monthly_term)
@@ -209,7 +543,7 @@ class LoanCalculation(ModelDiffMixin, TimeStamped):
 
     @property
     def estimated_monthly_savings(self):
-        if self.current_loan_monthly_payment:
+        if self.current_loan_monthly_payment and self.monthly_payment is not None:
             return self.current_loan_monthly_payment - self.monthly_payment
         else:
             return None
@@ -223,7 +557,8 @@ class LoanCalculation(ModelDiffMixin, TimeStamped):
 
     @property
     def current_loan_remaining_interest(self):
-        if self.current_loan_balance and self.current_loan_monthly_payment:
+        if (self.current_loan_balance and self.current_loan_monthly_payment and
+                self.current_loan_estimated_remaining_term is not None):
             principle_value = self.current_loan_balance
             pmt = self.current_loan_monthly_payment
             remaining_term = self.current_loan_estimated_remaining_term
@@ -233,6 +568,8 @@ class LoanCalculation(ModelDiffMixin, TimeStamped):
 
     @property
     def loan_interest(self):
+        if self.monthly_payment is None:
+            return None
         principle_value = self.loan_amount
         pmt = self.monthly_payment
         remaining_term = self.monthly_term
@@ -240,9 +577,20 @@ class LoanCalculation(ModelDiffMixin, TimeStamped):
 
     @property
     def interest_savings(self):
-        if self.current_loan_remaining_interest:
+        if self.current_loan_remaining_interest and self.loan_interest is not None:
             return self.current_loan_remaining_interest - self.loan_interest
 
+    @property
+    def apr(self):
+        """
+        The annual percentage rate, including the origination fees.
+        """
+        if self.qualified and self.monthly_payment:
+            amount_financed = float(self.loan_amount) - settings.DEFAULT_ORIGINATION_FEE
+            return 12 * solve_rate(self.monthly_term, -float(self.monthly_payment), amount_financed)
+        else:
+            return None
+
     @property
     def qualified(self):
         try:
@@ -257,15 +605,27 @@ class LoanCalculation(ModelDiffMixin, TimeStamped):
         except AttributeError:
             return None
 
+    def amortization_schedule(self):
+        """
+        Generate the month by month payment schedule (an empty schedule if the loan is disqualified).
+        """
+        if self.qualified and self.monthly_payment:
+            return amortization_schedule(self.loan_amount, self.rate, self.monthly_term, self.monthly_payment)
+        else:
+            return iter(())
+
     def save(self, *args, **kwargs):
-        self.calculate_current_loan_estimated_remaining_term()
-        self.calculate_rate()
-        self.calculate_maximum_term()
-        if self.maximum_term < self.monthly_term:
-            self.monthly_term = self.maximum_term
-        self.calculate_monthly_payment()
+        self.calculate()
 
         if self.has_changed:
+            self.fingerprint = self.get_fingerprint()
+            identical = self.get_identical()
+            if identical is not None:
+                # The same calculation was saved a moment ago, so refer to that rather than inserting it again
+                self.id, self.created, self.updated = identical
+                self._state.adding = False
+                self._initial = self._snapshot()
+                return
             self.id = None
             kwargs['force_insert'] = True
             try:
@@ -275,76 +635,238 @@ class LoanCalculation(ModelDiffMixin, TimeStamped):
 
         super().save(*args, **kwargs)
 
+    def record(self):
+        """
+        Save the calculation as save() does, unless there is a write-behind spool (see LOAN_CALCULATION_SPOOL) with
+        room for it. Then it is calculated and spooled, to be saved in the background, and is left without an id.
+        """
+        if calculation_spool is None:
+            return self.save()
+        recorded = self.fingerprint
+        self.calculate()
+        if not self.has_changed:
+            return
+        self.fingerprint = self.get_fingerprint()
+        if self.fingerprint == recorded:
+            # The calculation this was made from (a spooled one in the session, say) already has these values
+            return
+        self.created = self.updated = timezone.now()
+        if calculation_spool.put(self.get_record()):
+            self.id = None
+        else:
+            self.save()
+
+    def get_record(self):
+        """
+        The values of the fields other than the id, to make the calculation again with from_record.
+        """
+        return {field.attname: getattr(self, field.attname) for field in self._meta.concrete_fields
+                if not field.primary_key}
+
+    def get_fingerprint(self, inputs=None):
+        """
+        A hash of the inputs (get_inputs() by default), the loan company and loan type and the pricing plan's
+        digest, the same for any two calculations that come out the same.
+        """
+        if inputs is None:
+            inputs = self.get_inputs()
+        values = [self.loan_company_id, self.loan_type_id, self.pricing_plan.digest]
+        values.extend(self._meta.get_field(name).get_prep_value(inputs[name]) for name in self.CALCULATION_INPUTS)
+        return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_reusable(cls):
+        """
+        The saved calculations recent enough to be reused instead of inserting an identical one (see
+        LOAN_CALCULATION_REUSE_WINDOW), or None if none are.
+        """
+        window = settings.LOAN_CALCULATION_REUSE_WINDOW
+        if not window:
+            return None
+        return cls.objects.filter(created__gte=timezone.now() - datetime.timedelta(seconds=window))
+
+    def get_identical(self):
+        """
+        The (id, created, updated) of the latest reusable calculation with this fingerprint, or None.
+        """
+        reusable = self.get_reusable()
+        if reusable is None:
+            return None
+        return reusable.filter(fingerprint=self.fingerprint).order_by('-created').values_list(
+            'id', 'created', 'updated').first()
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Make an unsaved calculation from get_record's values (or their JSON). It counts as changed in every field,
+        but keeps the values it was made from for get_changed_inputs.
+        """
+        calculation = cls(**record)
+        calculation._recorded = calculation._initial
+        calculation._initial = None
+        return calculation
+
+    def calculate(self):
+        """
+        Calculate the rate, terms and payment from the entered data (without saving).
+        Only the steps that depend on the inputs changed since the calculation was loaded are redone, following
+        CALCULATION_DEPENDENCIES and VALUE_INDEX_DEPENDENCIES (see get_changed_inputs).
+        """
+        plan = self.pricing_plan
+        inputs = self.get_inputs()
+        if getattr(self, '_calculated', None) == (plan, inputs):
+            # Already calculated (by record() before save(), say)
+            return
+        changed = self.get_changed_inputs()
+
+        if self.depends_on(changed, 'current_loan_estimated_remaining_term'):
+            self.calculate_current_loan_estimated_remaining_term()
+        rate, monthly_term = self.rate, self.monthly_term
+        self.calculate_rate(changed)
+        self.calculate_maximum_term(changed)
+        if self.maximum_term < self.monthly_term:
+            self.monthly_term = self.maximum_term
+        if changed is not None:
+            changed.update(name for (name, value) in (('rate', rate), ('monthly_term', monthly_term))
+                           if getattr(self, name) != value)
+        if self.depends_on(changed, 'monthly_payment'):
+            self.calculate_monthly_payment()
+        self._calculated = (plan, self.get_inputs())
+
+    def get_inputs(self):
+        return {name: getattr(self, name) for name in self.CALCULATION_INPUTS}
+
+    def get_changed_inputs(self):
+        """
+        The set of the inputs that have changed since the calculation was loaded (from the database or a record),
+        or None if everything must be calculated: the loaded results were not calculated from the loaded inputs
+        with the current pricing plan (the stored fingerprint does not match them), or the credit score has changed.
+        """
+        loaded = self._initial if self._initial is not None else getattr(self, '_recorded', None)
+        if not loaded or not loaded.get('fingerprint'):
+            return None
+        inputs = {name: loaded.get(name, DEFERRED) for name in self.CALCULATION_INPUTS}
+        if any(value is DEFERRED for value in inputs.values()):
+            return None
+        if self.get_fingerprint(inputs) != loaded['fingerprint']:
+            return None
+        changed = {name for (name, value) in self.get_inputs().items() if value != inputs[name]}
+        if 'estimated_credit_score' in changed:
+            return None
+        return changed
+
+    def depends_on(self, changed, name):
+        return changed is None or not changed.isdisjoint(self.CALCULATION_DEPENDENCIES[name])
+
+    def lookups_depend_on(self, changed, additions):
+        return changed is None or any(
+            not changed.isdisjoint(self.VALUE_INDEX_DEPENDENCIES[addition.value_index_method_name])
+            for addition in additions)
+
+    def get_addition_value(self, addition, changed):
+        """
+        The value of a PricingAddition, looked up again only if the fields its value index depends on have changed.
+        """
+        try:
+            values = self._addition_values
+        except AttributeError:
+            values = self._addition_values = {}
+        if (changed is None or addition.value_type_id not in values or
+                not changed.isdisjoint(self.VALUE_INDEX_DEPENDENCIES[addition.value_index_method_name])):
+            values[addition.value_type_id] = addition.table.lookup(self.estimated_credit_score,
+                                                                   addition.value_index(self))
+        return values[addition.value_type_id]
+
     def calculate_current_loan_estimated_remaining_term(self):
         if self.current_loan_balance and self.current_loan_monthly_payment and self.current_loan_rate:
             rate = self.current_loan_rate / 12.0
-            pmt = -self.current_loan_monthly_payment
-            pv = self.current_loan_balance
+            pmt = -float(self.current_loan_monthly_payment)
+            pv = float(self.current_loan_balance)
             self.current_loan_estimated_remaining_term = int(round(nper(rate, pmt, pv)))
 
-    def calculate_rate(self):
+    @property
+    def pricing_plan(self):
+        return rate_book.get_plan(self.loan_company_id, self.loan_type_id)
+
+    def calculate_rate(self, changed=None):
+        additions = self.pricing_plan.rate_additions
+        if not self.lookups_depend_on(changed, additions):
+            return
         rate = 0.0
-        credit_score = self.estimated_credit_score
-        for value_type in LoanAdditionType.objects.filter(sum_in_rate_calculation=True,
-                                                          loan_company=self.loan_company,
-                                                          loan_type=self.loan_type):
-            value_index = self.get_value_index(value_type)
-            addition = self.get_addition(value_type, credit_score, value_index)
-            if addition < 0:
+        for addition in additions:
+            value = self.get_addition_value(addition, changed)
+            if value < 0:
                 # loan is disqualified
                 rate = -1.0
                 break
-            rate += addition
+            rate += value
         self.rate = rate
 
-    def calculate_maximum_term(self):
-        value_type = LoanAdditionType.objects.get(name='Maximum term',
-                                                  loan_company=self.loan_company,
-                                                  loan_type=self.loan_type)
-        credit_score = self.estimated_credit_score
-        value_index = self.get_value_index(value_type)
-        self.maximum_term = self.get_addition(value_type, credit_score, value_index)
+    def calculate_maximum_term(self, changed=None):
+        maximum_term = self.pricing_plan.maximum_term
+        if maximum_term is None:
+            raise LoanAdditionType.DoesNotExist('There is no Maximum term for {} {}'.format(self.loan_company_id,
+                                                                                           self.loan_type_id))
+        if not self.lookups_depend_on(changed, [maximum_term]):
+            return
+        self.maximum_term = self.get_addition_value(maximum_term, changed)
 
     def get_value_index(self, value_type):
         return getattr(self, value_type.value_index_method_name)()
 
+    # The ratios of whole cents are exact enough to compare with the value indices (and are what quotes use)
     def _get_value_index_loan_to_value(self):
-        return Decimal(self.loan_amount / self.estimated_collateral_value) * Decimal(100.0)
+        return Money.from_value(self.loan_amount).cents * 100 / Money.from_value(self.estimated_collateral_value).cents
 
     def _get_value_index_debt_to_income(self):
-        return Decimal(self.estimated_monthly_expenses / self.estimated_monthly_income) * Decimal(100.0)
+        return (Money.from_value(self.estimated_monthly_expenses).cents * 100 /
+                Money.from_value(self.estimated_monthly_income).cents)
 
     def _get_value_index_year_of_collateral(self):
         return self.estimated_year_of_collateral
 
     def get_addition(self, value_type, credit_score, value_index):
-
-        # Ensure that the upper bound of the indices is in range
-        indices = {'credit_score': credit_score,
-                   'value_index': value_index}
-        for fname in indices:
-            info = LoanAddition.objects.filter(loan_company=self.loan_company,
-                                               loan_type=self.loan_type,
-                                               value_type=value_type).aggregate(Max(fname))
-            max_value = info['{}__max'.format(fname)]
-
-            if indices[fname] > max_value:
-                indices[fname] = max_value
-
-        loan_additions = LoanAddition.objects.filter(
-            loan_company=self.loan_company,
-            loan_type=self.loan_type,
-            value_type=value_type,
-            credit_score__gte=indices['credit_score'],
-            value_index__gte=indices['value_index'])
-
-        # As we've adjusted the bounds, we should always get at least one result unless the table is missing
-        return loan_additions[0].value
+        """
+        The value of the first LoanAddition with credit_score >= credit_score and value_index >= value_index,
+        the indices being clamped to the largest in the table. The lookup is done on the compiled rate tables.
+        """
+        table = rate_book.get_table(self.loan_company_id, self.loan_type_id, value_type.pk)
+        return table.lookup(credit_score, value_index)
 
     def calculate_monthly_payment(self):
         if self.qualified > 0:
-            monthly_payment = pmt(self.rate / 12.0, self.monthly_term, -self.loan_amount)
-            self.monthly_payment = Decimal(monthly_payment).quantize(Decimal('0.01'))
+            monthly_payment = pmt(self.rate / 12.0, self.monthly_term, -float(self.loan_amount))
+            self.monthly_payment = Money.from_float(monthly_payment)
+
+
+def write_spooled_calculations(records):
+    """
+    Save the spooled calculations, leaving out those identical to another in the batch or to a reusable one.
+    """
+    calculations = [LoanCalculation.from_record(record) for record in records]
+    reusable = LoanCalculation.get_reusable()
+    if reusable is not None:
+        seen = set(reusable.filter(fingerprint__in={calculation.fingerprint for calculation in calculations})
+                   .values_list('fingerprint', flat=True))
+        unique = []
+        for calculation in calculations:
+            # Calculations spooled before they had fingerprints are all kept
+            if not calculation.fingerprint or calculation.fingerprint not in seen:
+                seen.add(calculation.fingerprint)
+                unique.append(calculation)
+        calculations = unique
+    LoanCalculation.objects.bulk_create(calculations)
+
+if settings.LOAN_CALCULATION_SPOOL:
+    # The spool's own thread would otherwise keep its database connection open between flushes
+    calculation_spool = Spool(settings.LOAN_CALCULATION_SPOOL, write_spooled_calculations,
+                              batch_size=settings.LOAN_CALCULATION_SPOOL_BATCH_SIZE,
+                              flush_interval=settings.LOAN_CALCULATION_SPOOL_FLUSH_INTERVAL,
+                              max_pending=settings.LOAN_CALCULATION_SPOOL_MAX_PENDING,
+                              encoder=MoneyJSONEncoder,
+                              cleanup=connection.close)
+else:
+    calculation_spool = None
 
 
 class LoanCompanyMessage(TimeStamped):
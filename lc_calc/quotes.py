@@ -0,0 +1,300 @@
+"""
+Vectorised loan quotes.
+
+These give the same rate, maximum_term, monthly_term and monthly_payment as saving a LoanCalculation
+for each applicant profile, but work on columns (NumPy arrays) of profiles using the compiled rate tables,
+so a batch of thousands of profiles costs a couple of queries at most and writes nothing.
+"""
+from collections import defaultdict
+from decimal import Decimal
+import datetime
+
+import numpy as np
+from django.conf import settings
+
+from lc_calc.models import LoanAdditionType, rate_book
+from lc_calc.utils.excel_functions import pmt, pv, rate as solve_rate
+
+CENT = Decimal('0.01')
+
+
+def round_cents(values):
+    """
+    Round an array of dollar amounts to whole cents, returned as a float array of cents.
+    This gives the same result as Decimal(value).quantize(Decimal('0.01')) does for each value.
+    """
+    values = np.asarray(values, dtype=float)
+    scaled = values * 100
+    cents = np.round(scaled)
+    # values * 100 is itself rounded, so near half a cent only the exact decimal rounding is reliable
+    for i in np.flatnonzero(np.abs(np.abs(scaled - cents) - 0.5) < 1e-6):
+        cents.flat[i] = float(Decimal(float(values.flat[i])).quantize(CENT).scaleb(2))
+    return cents
+
+
+def _value_index_loan_to_value(profiles):
+    return profiles['loan_amount'] * 100 / profiles['estimated_collateral_value']
+
+
+def _value_index_debt_to_income(profiles):
+    return profiles['estimated_monthly_expenses'] * 100 / profiles['estimated_monthly_income']
+
+
+def _value_index_year_of_collateral(profiles):
+    return profiles['estimated_year_of_collateral']
+
+# The vectorised equivalents of the LoanCalculation value index methods.
+# Currency columns are in cents, as Money is, so the ratios are those LoanCalculation works out.
+VALUE_INDEX_FUNCTIONS = {
+    '_get_value_index_loan_to_value': _value_index_loan_to_value,
+    '_get_value_index_debt_to_income': _value_index_debt_to_income,
+    '_get_value_index_year_of_collateral': _value_index_year_of_collateral}
+
+CURRENCY_COLUMNS = ('loan_amount',
+                    'estimated_collateral_value',
+                    'estimated_monthly_income',
+                    'estimated_monthly_expenses')
+
+PROFILE_COLUMNS = ('loan_amount',
+                   'monthly_term',
+                   'estimated_credit_score',
+                   'estimated_collateral_value',
+                   'estimated_monthly_income',
+                   'estimated_monthly_expenses',
+                   'estimated_year_of_collateral')
+
+
+def _get_profiles(loan_amount, monthly_term, estimated_credit_score, estimated_collateral_value,
+                  estimated_monthly_income, estimated_monthly_expenses, estimated_year_of_collateral):
+    if estimated_year_of_collateral is None:
+        estimated_year_of_collateral = datetime.datetime.now().year
+    profiles = {name: np.asarray(column, dtype=float) for (name, column) in zip(PROFILE_COLUMNS, (
+        loan_amount,
+        monthly_term,
+        estimated_credit_score,
+        estimated_collateral_value,
+        estimated_monthly_income,
+        estimated_monthly_expenses,
+        estimated_year_of_collateral))}
+    for name in CURRENCY_COLUMNS:
+        profiles[name] = round_cents(profiles[name])
+    return profiles
+
+
+def _lookup(plan, profiles):
+    """
+    Look up the rate (-1.0 where disqualified) and maximum term of the profiles in a PricingPlan.
+    """
+    if plan.maximum_term is None:
+        raise LoanAdditionType.DoesNotExist('There is no Maximum term')
+    credit_score = profiles['estimated_credit_score']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = 0.0
+        disqualified = False
+        for addition in plan.rate_additions:
+            value = addition.table.lookup_many(credit_score,
+                                               VALUE_INDEX_FUNCTIONS[addition.value_index_method_name](profiles))
+            disqualified = disqualified | (value < 0)
+            rate = rate + value
+        rate = np.where(disqualified, -1.0, rate)
+
+        maximum_term = plan.maximum_term
+        maximum_term = maximum_term.table.lookup_many(
+            credit_score, VALUE_INDEX_FUNCTIONS[maximum_term.value_index_method_name](profiles))
+    return rate, maximum_term
+
+
+def _price(profiles, rate, maximum_term, origination_fee):
+    """
+    Work out the term, payment and APR of the profiles from their rate and maximum term.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        disqualified = rate < 0
+        monthly_term = np.minimum(profiles['monthly_term'], maximum_term)
+
+        monthly_payment = round_cents(pmt(rate / 12.0, monthly_term, -profiles['loan_amount'] / 100)) / 100
+        monthly_payment = np.where(disqualified, np.nan, monthly_payment)
+
+        amount_financed = profiles['loan_amount'] / 100 - np.asarray(origination_fee, dtype=float)
+        apr = 12 * solve_rate(monthly_term, -monthly_payment, amount_financed)
+
+    return {'rate': rate,
+            'maximum_term': maximum_term,
+            'monthly_term': monthly_term,
+            'monthly_payment': monthly_payment,
+            'apr': apr}
+
+
+def _quote(loan_company, loan_type, profiles, origination_fee):
+    """
+    Quote the profiles (columns as arrays, currency in cents). The columns are only broadcast together where they
+    are combined, so lookups on columns that are constant are done once.
+    """
+    rate, maximum_term = _lookup(rate_book.get_plan(loan_company.pk, loan_type.pk), profiles)
+    return _price(profiles, rate, maximum_term, origination_fee)
+
+
+def batch_quote(loan_company, loan_type, loan_amount, monthly_term=60,
+                estimated_credit_score=850,
+                estimated_collateral_value=1000.00,
+                estimated_monthly_income=settings.DEFAULT_MONTHLY_INCOME,
+                estimated_monthly_expenses=settings.DEFAULT_MONTHLY_EXPENSES,
+                estimated_year_of_collateral=None,
+                origination_fee=settings.DEFAULT_ORIGINATION_FEE):
+    """
+    Quote a batch of applicant profiles for a loan company and loan type.
+    Each argument after loan_type may be a scalar or an array (they are broadcast together) and the defaults
+    are those of LoanCalculation. Returns a dictionary of arrays:
+    - rate: the annual rate (-1.0 where the loan is disqualified)
+    - maximum_term: the maximum term in months
+    - monthly_term: the term capped to the maximum term
+    - monthly_payment: the monthly payment in dollars (NaN where the loan is disqualified)
+    - apr: the annual percentage rate including the origination fee (NaN where the loan is disqualified)
+    """
+    profiles = _get_profiles(loan_amount, monthly_term, estimated_credit_score, estimated_collateral_value,
+                             estimated_monthly_income, estimated_monthly_expenses, estimated_year_of_collateral)
+    shape = np.broadcast(*profiles.values()).shape
+    quotes = _quote(loan_company, loan_type, profiles, origination_fee)
+    return {name: np.broadcast_to(values, shape).copy() for (name, values) in quotes.items()}
+
+
+def quote_grid(loan_company, loan_type, loan_amounts, monthly_terms,
+               estimated_credit_score=850,
+               estimated_collateral_value=1000.00,
+               estimated_monthly_income=settings.DEFAULT_MONTHLY_INCOME,
+               estimated_monthly_expenses=settings.DEFAULT_MONTHLY_EXPENSES,
+               estimated_year_of_collateral=None,
+               origination_fee=settings.DEFAULT_ORIGINATION_FEE):
+    """
+    Quote one applicant profile for every combination of loan_amounts (rows) and monthly_terms (columns).
+    Returns the same dictionary as batch_quote with (amounts x terms) arrays. The rate lookups are done once per
+    amount, or just once if they do not depend on the amount, and broadcast across the terms.
+    """
+    profiles = _get_profiles(np.asarray(loan_amounts, dtype=float)[:, np.newaxis],
+                             np.asarray(monthly_terms, dtype=float)[np.newaxis, :],
+                             estimated_credit_score, estimated_collateral_value,
+                             estimated_monthly_income, estimated_monthly_expenses, estimated_year_of_collateral)
+    shape = (len(loan_amounts), len(monthly_terms))
+    quotes = _quote(loan_company, loan_type, profiles, origination_fee)
+    return {name: np.broadcast_to(values, shape).copy() for (name, values) in quotes.items()}
+
+
+def maximum_loan_amounts(loan_company, loan_type, monthly_payment, monthly_terms,
+                         estimated_credit_score=850,
+                         estimated_collateral_value=1000.00,
+                         estimated_monthly_income=settings.DEFAULT_MONTHLY_INCOME,
+                         estimated_monthly_expenses=settings.DEFAULT_MONTHLY_EXPENSES,
+                         estimated_year_of_collateral=None,
+                         origination_fee=settings.DEFAULT_ORIGINATION_FEE):
+    """
+    Find the largest loan amount (to the cent) that qualifies and has a monthly payment of no more than
+    monthly_payment, for one applicant profile and each of monthly_terms.
+    Returns the batch_quote dictionary of arrays for the terms, with the loan_amount added (NaN where no
+    amount qualifies).
+
+    The loan amount only affects the rate and maximum term through the loan to value index and the tables
+    are piecewise constant between their value indices, so the amounts are split into segments at those
+    breakpoints. Each segment has one rate and maximum term, from which the affordable amount is pv() of
+    the payment, and the answer is the largest affordable amount that lies in its segment.
+    """
+    profile = {'estimated_credit_score': estimated_credit_score,
+               'estimated_collateral_value': estimated_collateral_value,
+               'estimated_monthly_income': estimated_monthly_income,
+               'estimated_monthly_expenses': estimated_monthly_expenses,
+               'estimated_year_of_collateral': estimated_year_of_collateral,
+               'origination_fee': origination_fee}
+    monthly_terms = np.asarray(monthly_terms, dtype=float)
+    collateral_cents = int(round_cents(estimated_collateral_value))
+
+    plan = rate_book.get_plan(loan_company.pk, loan_type.pk)
+    if plan.maximum_term is None:
+        raise LoanAdditionType.DoesNotExist('There is no Maximum term')
+    breakpoints = sorted({value_index
+                          for addition in plan.rate_additions + (plan.maximum_term,)
+                          if addition.value_index_method_name == '_get_value_index_loan_to_value'
+                          for value_index in addition.table.value_indices})
+
+    # The segments of loan amounts (in cents) with loan to value in (previous breakpoint, breakpoint]
+    uppers = [max(breakpoint * collateral_cents // 100, -1) for breakpoint in breakpoints] + [np.inf]
+    lowers = [0] + [upper + 1 for upper in uppers[:-1]]
+    segments = [(lower, upper) for (lower, upper) in zip(lowers, uppers) if lower <= upper]
+    lowers = np.array([lower for (lower, upper) in segments], dtype=float)
+    uppers = np.array([upper for (lower, upper) in segments], dtype=float)
+
+    # The rate and maximum term of each segment
+    segment_quotes = batch_quote(loan_company, loan_type, np.where(np.isinf(uppers), lowers, uppers) / 100, 1,
+                                 **profile)
+    monthly_term = np.minimum(monthly_terms[np.newaxis, :], segment_quotes['maximum_term'][:, np.newaxis])
+    # The payment is rounded to the cent, so anything up to half a cent over the budget is affordable
+    budget = monthly_payment + 0.005
+    with np.errstate(divide='ignore', invalid='ignore'):
+        affordable = np.floor(pv(segment_quotes['rate'][:, np.newaxis] / 12.0, monthly_term, -budget) * 100)
+        affordable = np.minimum(affordable, uppers[:, np.newaxis])
+        qualifies = ((affordable >= lowers[:, np.newaxis]) &
+                     (segment_quotes['rate'] >= 0)[:, np.newaxis] &
+                     np.isfinite(affordable))
+        loan_amount = np.where(qualifies, affordable, -np.inf).max(axis=0)
+    loan_amount = np.where(np.isinf(loan_amount), np.nan, loan_amount)
+
+    # Settle the last cent with full quotes either side, as pv() and the rounding of ties are not exact
+    candidates = loan_amount[np.newaxis, :] + np.array([1, 0, -1])[:, np.newaxis]
+    quotes = batch_quote(loan_company, loan_type, candidates / 100, monthly_terms, **profile)
+    with np.errstate(invalid='ignore'):
+        affordable = (quotes['rate'] >= 0) & (quotes['monthly_payment'] <= monthly_payment)
+    best = np.argmax(affordable, axis=0)
+    columns = np.arange(len(monthly_terms))
+    quotes = {name: values[best, columns] for (name, values) in quotes.items()}
+    quotes['loan_amount'] = np.where(affordable.any(axis=0), candidates[best, columns] / 100, np.nan)
+    return quotes
+
+
+COMPARISON_ORDERINGS = ('monthly_payment', 'total_interest')
+
+
+def compare_loan_companies(loan_type, loan_amount, monthly_term=60,
+                           estimated_credit_score=850,
+                           estimated_collateral_value=1000.00,
+                           estimated_monthly_income=settings.DEFAULT_MONTHLY_INCOME,
+                           estimated_monthly_expenses=settings.DEFAULT_MONTHLY_EXPENSES,
+                           estimated_year_of_collateral=None,
+                           origination_fee=settings.DEFAULT_ORIGINATION_FEE,
+                           order_by='monthly_payment'):
+    """
+    Quote one applicant profile for a loan type at every loan company offering it.
+    Returns a list of dictionaries (loan_company, rate, maximum_term, monthly_term, monthly_payment, apr and
+    total_interest) ordered by order_by, one of COMPARISON_ORDERINGS, with the disqualified companies last.
+
+    The addition types of all the companies are read in one query (to make any pricing plans that are not already
+    made) and each company is only looked up in its plan, with the payments and APRs of all of them worked out
+    together.
+    """
+    if order_by not in COMPARISON_ORDERINGS:
+        raise ValueError('Cannot order a comparison by {}'.format(order_by))
+    profiles = _get_profiles(loan_amount, monthly_term, estimated_credit_score, estimated_collateral_value,
+                             estimated_monthly_income, estimated_monthly_expenses, estimated_year_of_collateral)
+
+    loan_companies = {}
+    value_types = defaultdict(list)
+    for value_type in LoanAdditionType.objects.filter(loan_type=loan_type).select_related('loan_company') \
+            .order_by('id'):
+        loan_companies[value_type.loan_company_id] = value_type.loan_company
+        value_types[value_type.loan_company_id].append(value_type)
+    plans = {loan_company_id: rate_book.get_plan(loan_company_id, loan_type.pk, company_value_types)
+             for (loan_company_id, company_value_types) in value_types.items()}
+
+    # Companies without a maximum term table, or with an empty table (all its rows deleted, or being imported
+    # row by row), cannot quote and are left out
+    loan_company_ids = sorted((pk for (pk, plan) in plans.items() if plan.quotable),
+                              key=lambda pk: loan_companies[pk].title)
+    rates = np.empty(len(loan_company_ids))
+    maximum_terms = np.empty(len(loan_company_ids))
+    for (i, loan_company_id) in enumerate(loan_company_ids):
+        rates[i], maximum_terms[i] = _lookup(plans[loan_company_id], profiles)
+
+    quotes = _price(profiles, rates, maximum_terms, origination_fee)
+    quotes['total_interest'] = quotes['monthly_payment'] * quotes['monthly_term'] - profiles['loan_amount'] / 100
+    # NaN (disqualified) sorts last, and the sort is stable so ties stay in company order
+    order = np.argsort(quotes[order_by], kind='mergesort')
+    return [dict({name: float(values[i]) for (name, values) in quotes.items()},
+                 loan_company=loan_companies[loan_company_ids[i]])
+            for i in order]
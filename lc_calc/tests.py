@@ -1,7 +1,37 @@
+import csv
+from decimal import Decimal
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+import numpy as np
+from django.core.cache import get_cache
+from django.http import Http404
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
 
-from lc_calc.utils.excel_functions import nper, pmt
-from lc_calc.models import LoanCompany, LoanType, LoanCalculation
+from lc_calc.utils.excel_functions import nper, pmt, pv, fv, ipmt, ppmt, cumipmt, rate
+from lc_calc.utils.rate_table import RateTable, RateBook, compile_rows
+from lc_calc.utils.amortization import amortization_schedule
+from lc_calc.utils.money import Money, MoneyJSONEncoder
+from lc_calc.utils.spool import Spool
+import lc_calc.models as lcmodels
+from lc_calc.models import (LoanCompany,
+                            LoanType,
+                            LoanAdditionType,
+                            LoanAddition,
+                            LoanAdditionTable,
+                            LoanCalculation,
+                            load_rate_tables)
+from lc_calc.quotes import batch_quote, maximum_loan_amounts, compare_loan_companies
+from lc_calc.forms import LoanCalculationForm
+from lc_calc.views import CalculationView, AmortizationScheduleView
+from lc_calc.import_csv.import_loan_data import LoanDataImporter, LoanDataImportError
 
 
 class TestExcelFunctions(TestCase):
@@ -35,6 +65,326 @@ class TestExcelFunctions(TestCase):
             actual = pmt(**params)
             self.assertAlmostEqual(actual, desired)
 
+    # Excel reference values, with the full set of arguments for each function
+    excel_reference_values = {
+        nper: [
+            ({'rate': 0.01, 'pmt': -200, 'pv': 10000, 'fv': 0, 'pmt_type': 0}, 69.6607168936),
+            ({'rate': 0.01, 'pmt': -10100, 'pv': 10000, 'fv': 0, 'pmt_type': 0}, 1.0),
+            ({'rate': 0.01, 'pmt': -100, 'pv': -1000, 'fv': 10000, 'pmt_type': 1}, 59.6738656743),
+            ({'rate': 0.01, 'pmt': -100, 'pv': -1000, 'fv': 10000, 'pmt_type': 0}, 60.0821228538),
+            ({'rate': 0.01, 'pmt': -100, 'pv': -1000, 'fv': 0, 'pmt_type': 0}, -9.57859403981),
+            ({'rate': 0.0, 'pmt': -100, 'pv': 1000, 'fv': 0, 'pmt_type': 0}, 10.0)],
+        pmt: [
+            ({'rate': 0.01, 'nperiods': 1, 'pv': -100, 'fv': 0, 'pmt_type': 1}, 100.0),
+            ({'rate': 0.02, 'nperiods': 12, 'pv': -12000, 'fv': 0, 'pmt_type': 0}, 1134.71515948),
+            ({'rate': 0.0, 'nperiods': 10, 'pv': 0, 'fv': 10000, 'pmt_type': 1}, -1000.0),
+            ({'rate': 0.01, 'nperiods': 10, 'pv': 0, 'fv': 10000, 'pmt_type': 1}, -946.35719358)],
+        pv: [
+            ({'rate': 0.08 / 12, 'nperiods': 240, 'pmt': 500, 'fv': 0, 'pmt_type': 0}, -59777.1458512),
+            ({'rate': 0.0, 'nperiods': 10, 'pmt': -100, 'fv': 0, 'pmt_type': 0}, 1000.0)],
+        fv: [
+            ({'rate': 0.06 / 12, 'nperiods': 10, 'pmt': -200, 'pv': -500, 'pmt_type': 1}, 2581.40337406),
+            ({'rate': 0.0, 'nperiods': 10, 'pmt': -100, 'pv': 0, 'pmt_type': 0}, 1000.0)],
+        ipmt: [
+            ({'rate': 0.1 / 12, 'per': 1, 'nperiods': 36, 'pv': 8000, 'fv': 0, 'pmt_type': 0}, -66.6666666667),
+            ({'rate': 0.1, 'per': 3, 'nperiods': 3, 'pv': 8000, 'fv': 0, 'pmt_type': 0}, -292.447129909),
+            ({'rate': 0.1, 'per': 1, 'nperiods': 3, 'pv': 8000, 'fv': 0, 'pmt_type': 1}, 0.0)],
+        ppmt: [
+            ({'rate': 0.1 / 12, 'per': 1, 'nperiods': 24, 'pv': 2000, 'fv': 0, 'pmt_type': 0}, -75.6231860084),
+            ({'rate': 0.08, 'per': 10, 'nperiods': 10, 'pv': 200000, 'fv': 0, 'pmt_type': 0}, -27598.0534624)],
+        cumipmt: [
+            ({'rate': 0.09 / 12, 'nperiods': 360, 'pv': 125000, 'start_period': 13, 'end_period': 24, 'pmt_type': 0},
+             -11135.2321308),
+            ({'rate': 0.09 / 12, 'nperiods': 360, 'pv': 125000, 'start_period': 1, 'end_period': 1, 'pmt_type': 0},
+             -937.5)]}
+
+    def test_reference_values(self):
+        """
+        Test each function on its reference values one at a time and all at once as arrays.
+        """
+        for (function, test_data) in self.excel_reference_values.items():
+            for (params, desired) in test_data:
+                self.assertAlmostEqual(function(**params), desired)
+
+            array_params = {name: np.array([params[name] for (params, desired) in test_data])
+                            for name in test_data[0][0]}
+            for (actual, (params, desired)) in zip(function(**array_params), test_data):
+                self.assertAlmostEqual(actual, desired)
+
+    def test_cumipmt(self):
+        """
+        The cumulative interest is the sum of the interest payments.
+        """
+        for pmt_type in (0, 1):
+            for (start_period, end_period) in ((1, 1), (1, 12), (3, 10), (36, 36)):
+                desired = sum(ipmt(0.01, per, 36, 8000, 0, pmt_type) for per in range(start_period, end_period + 1))
+                self.assertAlmostEqual(cumipmt(0.01, 36, 8000, start_period, end_period, pmt_type), desired)
+
+    def test_rate(self):
+        """
+        Test rate against an Excel reference value, then that it inverts pmt over arrays and flags failures.
+        """
+        self.assertAlmostEqual(rate(48, -200, 8000), 0.0077014725)
+
+        rates = np.linspace(0.0005, 0.03, 50)
+        nperiods = np.arange(6, 306, 6)
+        for pmt_type in (0, 1):
+            payments = pmt(rates, nperiods, 10000, 0, pmt_type)
+            actual = rate(nperiods, payments, 10000, 0, pmt_type, guess=0.5)
+            self.assertTrue(np.allclose(actual, rates, rtol=0, atol=1e-9))
+
+        actual, failed = rate([36, 36, 36], [-300, 300, np.nan], 10000, full_output=True)
+        self.assertEqual(failed.tolist(), [False, True, True])
+        self.assertTrue(np.isnan(actual[1:]).all())
+
+        # Without a root between -100% and the widest bracket nothing is reported, whatever Newton settles on
+        with np.errstate(over='raise', invalid='raise'):
+            actual, failed = rate([13, 51, 95, 104], [326, -369, -2, 13], [4200, -2400, -8500, 3600],
+                                  [0, 0, -3900, 4900], full_output=True)
+        self.assertTrue(failed.all())
+        self.assertTrue(np.isnan(actual).all())
+
+        # A 0% loan is exactly 0, and one just above it is not rounded down
+        self.assertEqual(rate(36, -10000 / 36, 10000), 0.0)
+        self.assertEqual(rate(12, -1000, 12000, 0, 1), 0.0)
+        self.assertGreater(rate(12, -1000.01, 12000), 0.0)
+
+
+class TestAmortizationSchedule(TestCase):
+
+    def test_schedule(self):
+        """
+        The principal payments add up to the loan and the interest to the total paid less the loan.
+        The regular payment is rounded up, so the last payment pays off what is left and is no more than it.
+        """
+        schedule = list(amortization_schedule(Decimal('10000.00'), 0.043, 36, Decimal('296.58')))
+        self.assertEqual(len(schedule), 36)
+        self.assertEqual(schedule[0].interest, Decimal('35.83'))
+        self.assertEqual(schedule[0].principal, Decimal('260.75'))
+        self.assertEqual(schedule[-1].balance, Decimal('0.00'))
+        self.assertEqual(sum(p.principal for p in schedule), Decimal('10000.00'))
+        self.assertEqual(sum(p.interest for p in schedule),
+                         sum(p.payment for p in schedule) - Decimal('10000.00'))
+        for p in schedule:
+            self.assertEqual(p.principal + p.interest, p.payment)
+        self.assertTrue(all(p.payment == Decimal('296.58') for p in schedule[:-1]))
+        self.assertLessEqual(schedule[-1].payment, Decimal('296.58'))
+
+
+class TestMoney(TestCase):
+
+    def test_conversion(self):
+        """
+        Converting rounds as Decimal.quantize does, including the floats that are just either side of half a cent.
+        """
+        cent = Decimal('0.01')
+        for value in (0.125, 0.135, 1.005, 2.675, 296.575, 1e7 + 0.005, -1.005, 0.0, 12345.678):
+            self.assertEqual(Money.from_value(value).to_decimal(), Decimal(value).quantize(cent))
+        for value in ('0.125', '-3.335', '10000', '9999.995'):
+            self.assertEqual(Money.from_value(value).to_decimal(), Decimal(value).quantize(cent))
+        self.assertEqual(Money.from_value(12).cents, 1200)
+        self.assertEqual(str(Money(-5)), '-0.05')
+        self.assertEqual(str(Money(123456)), '1234.56')
+
+    def test_arithmetic(self):
+        payment = Money.from_value('296.58')
+        self.assertEqual(payment * 36 - Money.from_value('10000.00'), Money.from_value('676.88'))
+        self.assertEqual(-payment, Decimal('-296.58'))
+        self.assertEqual(float(payment), 296.58)
+        self.assertEqual(payment + Decimal('0.005'), Decimal('296.585'))
+        self.assertEqual(hash(payment), hash(Decimal('296.58')))
+        self.assertTrue(Money(1) < Money(2) <= Decimal('0.02') < Money(3) < 1)
+        self.assertFalse(Money(0))
+        self.assertEqual(round(payment, 1), 296.6)
+        # Floats compare exactly, as with Decimal, so that equal values hash equally
+        self.assertNotEqual(payment, 296.58)
+        self.assertEqual(Money(2950), 29.5)
+        self.assertEqual(hash(Money(2950)), hash(29.5))
+        self.assertIn(29.5, {Money(2950)})
+        self.assertNotIn(296.58, {payment})
+        self.assertTrue(Money(10) < 0.1 < Money(11))
+        self.assertEqual(sum([payment, payment]), Money(59316))
+        self.assertIsInstance(sum([payment, payment]), Money)
+        self.assertEqual(payment - 296, Money(58))
+
+
+class TestRateTable(TestCase):
+
+    @staticmethod
+    def brute_force_lookup(rows, credit_score, value_index):
+        """
+        The original LoanAddition query based lookup.
+        """
+        credit_score = min(credit_score, max(r[0] for r in rows))
+        value_index = min(value_index, max(r[1] for r in rows))
+        return [r[2] for r in sorted(rows, key=lambda r: (r[0], r[1]))
+                if r[0] >= credit_score and r[1] >= value_index][0]
+
+    def test_lookup(self):
+        """
+        Test the compiled lookup against the query based lookup on full and sparse tables.
+        """
+        full_rows = [(cs, vi, cs + vi / 1000.0) for cs in (0, 449, 599, 759, 850) for vi in (6, 12, 24, 60)]
+        sparse_rows = [r for r in full_rows if (r[0] + r[1]) % 3]
+        for rows in (full_rows, sparse_rows):
+            table = RateTable.from_rows(rows)
+            for credit_score in (-1, 0, 1, 449, 450, 700, 850, 900):
+                for value_index in (0, 6, 7, 12.5, 60, 61):
+                    self.assertEqual(table.lookup(credit_score, value_index),
+                                     self.brute_force_lookup(rows, credit_score, value_index))
+
+    def test_dense_lookup(self):
+        """
+        The direct indexed lookup of integer axes must agree with the bisection.
+        """
+        full_rows = [(cs, vi, cs + vi / 1000.0) for cs in (0, 449, 599, 759, 850) for vi in (6, 12, 24, 60)]
+        sparse_rows = [r for r in full_rows if (r[0] + r[1]) % 3]
+        credit_scores = np.array([-1, 0, 1, 449, 450, 599.5, 700, 850, 900])[:, np.newaxis]
+        value_indices = np.array([-3, 0, 6, 7, 12.5, 60, 61])[np.newaxis, :]
+        for rows in (full_rows, sparse_rows):
+            table = RateTable.from_rows(rows)
+            self.assertTrue(table.dense)
+            expected = [[self.brute_force_lookup(rows, credit_score, value_index) for value_index in value_indices[0]]
+                        for credit_score in credit_scores[:, 0]]
+            self.assertEqual(table.lookup_many(credit_scores, value_indices).tolist(), expected)
+        self.assertFalse(RateTable.from_rows([(0, 0.5, 1.0), (850, 1, 2.0)]).dense)
+
+    def test_validate(self):
+        self.assertEqual(RateTable.from_rows([(0, 0, 60)]).validate(), [])
+        problems = RateTable.from_rows([(0, 6, 0.01), (0, 12, 0.02), (700, 6, 0.03)]).validate()
+        self.assertEqual(len(problems), 2)
+        self.assertIn('700', problems[0])
+        self.assertIn('credit score 700 and value index 12', problems[1])
+        self.assertEqual(RateTable.from_arrays(np.array([0.0, 900, 850]), np.array([0.0]),
+                                               np.zeros((3, 1))).validate(),
+                         ['The credit scores are not in increasing order'])
+
+    def test_empty(self):
+        with self.assertRaises(IndexError):
+            RateTable.from_rows([]).lookup(700, 50)
+
+    def test_rate_book_versions(self):
+        """
+        A change bumped in one process should only drop the affected snapshot in another.
+        """
+        tables = {(1, 1): [(1, 850, 10, 0.05)],
+                  (1, 2): [(2, 850, 10, 0.06)]}
+        shared_cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='rate_book_test')
+
+        def loader(company_id, loan_type_id):
+            return compile_rows(tables[(company_id, loan_type_id)])
+        this_process = RateBook(loader, shared_cache)
+        other_process = RateBook(loader, shared_cache)
+
+        self.assertEqual(other_process.get_table(1, 1, 1).lookup(700, 5), 0.05)
+        self.assertEqual(other_process.get_table(1, 2, 2).lookup(700, 5), 0.06)
+        other_snapshot = other_process.get_snapshot(1, 2)
+
+        tables[(1, 1)] = [(1, 850, 10, 0.07)]
+        this_process.bump(1, 1)
+        self.assertEqual(other_process.get_table(1, 1, 1).lookup(700, 5), 0.05)  # not synced yet
+        other_process.sync()
+        self.assertEqual(other_process.get_table(1, 1, 1).lookup(700, 5), 0.07)
+        self.assertIs(other_process.get_snapshot(1, 2), other_snapshot)
+
+        # A process that recompiles between a bump and the commit of the change gets the old rows, so the bumps
+        # made in a transaction are made again once it has committed
+        with this_process.after_commit():
+            this_process.bump(1, 1)
+            other_process.sync()
+            self.assertEqual(other_process.get_table(1, 1, 1).lookup(700, 5), 0.07)
+            tables[(1, 1)] = [(1, 850, 10, 0.08)]
+        other_process.sync()
+        self.assertEqual(other_process.get_table(1, 1, 1).lookup(700, 5), 0.08)
+        self.assertIs(other_process.get_snapshot(1, 2), other_snapshot)
+
+    def test_shared_tables(self):
+        """
+        Identical tables should be shared between snapshots, in memory and in a rate book file.
+        """
+        tables = {(1, 1): [(1, 850, 10, 0.05), (2, 850, 0, 60.0)],
+                  (1, 2): [(3, 850, 10, 0.05), (4, 850, 0, 72.0)]}
+        shared_cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='shared_tables_test')
+        rate_book = RateBook(lambda company_id, loan_type_id: compile_rows(tables[(company_id, loan_type_id)]),
+                             shared_cache)
+        self.assertIs(rate_book.get_table(1, 1, 1), rate_book.get_table(1, 2, 3))
+        self.assertIsNot(rate_book.get_table(1, 1, 2), rate_book.get_table(1, 2, 4))
+
+        # The digest is worked out from the rows without keeping arrays, and is the same for a packed table
+        table = RateTable.from_rows([(0, 6, 0.01), (0, 12, 0.02), (700, 6, 0.03)])
+        digest = table.digest
+        self.assertIsNone(table._arrays)
+        self.assertEqual(RateTable.from_arrays(*table.arrays).digest, digest)
+        self.assertEqual(RateTable.from_rows([(0, 6, 0.01), (0, 6, 0.05), (0, 12, 0.02), (700, 6, 0.03)]).digest,
+                         digest)
+
+        # Compiling through the rate book, a repeated table is found from its rows and not compiled again
+        rows = [(5, 0, 6, 0.01), (5, 0, 12, 0.02), (5, 700, 6, 0.03)]
+        with mock.patch.object(RateTable, 'from_rows', wraps=RateTable.from_rows) as from_rows:
+            self.assertIs(rate_book.compile_rows(rows)[5], rate_book.compile_rows(rows)[5])
+        self.assertEqual(from_rows.call_count, 1)
+        self.assertEqual(rate_book.compile_rows(rows)[5].digest, digest)
+
+        folder = tempfile.mkdtemp()
+        try:
+            rate_book.path = os.path.join(folder, 'rate_book')
+            rate_book.write_file([(1, 1), (1, 2)])
+            rate_book.sync()
+            self.assertEqual(rate_book.get_snapshot(1, 1), rate_book.file.get_snapshot(1, 1))
+            self.assertIs(rate_book.get_table(1, 1, 1), rate_book.get_table(1, 2, 3))
+            self.assertEqual(rate_book.get_table(1, 2, 4).lookup(700, 0), 72.0)
+            self.assertEqual(os.path.getsize(rate_book.path) % 8, 0)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_rate_book_file(self):
+        """
+        The snapshots in a rate book file should be used until they change, and reloaded when it is replaced.
+        """
+        tables = {(1, 1): [(1, 700, 20, 0.04), (1, 850, 10, 0.05)],
+                  (1, 2): [(2, 850, 10, 0.06)]}
+        loaded = []
+
+        def loader(company_id, loan_type_id):
+            loaded.append((company_id, loan_type_id))
+            return compile_rows(tables[(company_id, loan_type_id)])
+        shared_cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='rate_book_file_test')
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'rate_book')
+            compiler = RateBook(loader, shared_cache, path)
+            worker = RateBook(loader, shared_cache, path)
+            compiler.write_file([(1, 1), (1, 2)])
+            del loaded[:]
+
+            worker.sync()
+            self.assertEqual(worker.get_table(1, 1, 1).lookup(600, 15), 0.04)
+            self.assertEqual(list(worker.get_table(1, 1, 1).lookup_many([600, 800], [15, 5])), [0.04, 0.05])
+            self.assertEqual(loaded, [])
+
+            tables[(1, 1)] = [(1, 850, 10, 0.07)]
+            compiler.bump(1, 1)
+            worker.sync()
+            self.assertEqual(worker.get_table(1, 1, 1).lookup(600, 5), 0.07)
+            self.assertEqual(worker.get_table(1, 2, 2).lookup(600, 5), 0.06)
+            self.assertEqual(loaded, [(1, 1)])
+
+            compiler.write_file([(1, 1), (1, 2)])
+            del loaded[:]
+            worker.sync()
+            self.assertEqual(worker.get_table(1, 1, 1).lookup(600, 5), 0.07)
+            self.assertEqual(loaded, [])
+
+            # A version that has gone from the cache (evicted, or a restart) is not trusted to match the file
+            tables[(1, 2)] = [(2, 850, 10, 0.08)]
+            compiler.bump(1, 2)
+            shared_cache.clear()
+            worker.sync()
+            self.assertEqual(worker.get_table(1, 2, 2).lookup(600, 5), 0.08)
+            self.assertEqual(loaded, [(1, 2)])
+        finally:
+            shutil.rmtree(folder)
+
 
 class TestCalculations(TestCase):
     """
@@ -94,3 +444,657 @@ class TestCalculations(TestCase):
             for (attname, desired) in all_desired.items():
                 actual = getattr(loan_calculation, attname)
                 self.assertEqual(round(actual, 2), round(desired, 2))
+
+
+class TestModelDiffMixin(TestCase):
+    fixtures = ['test_loancompanies.json',
+                'test_loantypes.json',
+                'test_loanadditiontypes.json',
+                'test_loanadditions.json']
+
+    def test_changes(self):
+        loan_calculation = LoanCalculation(loan_company=LoanCompany.objects.get(slug='hawaiian-institution'),
+                                           loan_type=LoanType.objects.get(name='Used Vehicles'),
+                                           loan_amount=Decimal('9000.00'),
+                                           estimated_collateral_value=Decimal('15000.00'))
+        loan_calculation.save()
+        self.assertFalse(loan_calculation.has_changed)
+
+        loan_calculation = LoanCalculation.objects.get(pk=loan_calculation.pk)
+        self.assertFalse(loan_calculation.has_changed)
+        loan_calculation.loan_amount = Decimal('9000.00')
+        self.assertFalse(loan_calculation.has_changed)
+        loan_calculation.loan_amount = Decimal('9500.00')
+        self.assertEqual(loan_calculation.changed_fields, ['loan_amount'])
+        self.assertEqual(loan_calculation.get_field_diff('loan_amount'), (Decimal('9000.00'), Decimal('9500.00')))
+
+        # Deferred fields are not loaded to track them
+        loan_calculation = LoanCalculation.objects.only('id', 'monthly_term').get(pk=loan_calculation.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(loan_calculation.has_changed)
+
+        # Untracked instances count as changed
+        untracked = list(LoanCalculation.objects.untracked().filter(pk=loan_calculation.pk))
+        self.assertIsNone(untracked[0]._initial)
+        self.assertTrue(untracked[0].has_changed)
+        self.assertIsNotNone(LoanCalculation.objects.get(pk=loan_calculation.pk)._initial)
+
+
+class TestBatchQuote(TestCase):
+    """
+    The vectorised quotes must match the row by row model calculations.
+    """
+    fixtures = ['test_loancompanies.json',
+                'test_loantypes.json',
+                'test_loanadditiontypes.json',
+                'test_loanadditions.json']
+
+    def test_batch_quote(self):
+        loan_company = LoanCompany.objects.get(slug='hawaiian-institution')
+        profiles = [{'loan_amount': loan_amount,
+                     'monthly_term': monthly_term,
+                     'estimated_credit_score': credit_score,
+                     'estimated_collateral_value': 15000.00}
+                    for loan_amount in (900.00, 1500.00, 7499.99, 9000.00, 10000.00)
+                    for monthly_term in (12, 36, 72)
+                    for credit_score in (300, 649, 650, 850)]
+        for loan_type in LoanType.objects.filter(name__in=['Used Vehicles', 'New Vehicles']):
+            quotes = batch_quote(loan_company, loan_type,
+                                 **{name: [p[name] for p in profiles] for name in profiles[0]})
+            for (i, params) in enumerate(profiles):
+                loan_calculation = LoanCalculation(loan_company=loan_company, loan_type=loan_type, **params)
+                loan_calculation.save()
+                self.assertEqual(quotes['rate'][i], loan_calculation.rate)
+                self.assertEqual(quotes['maximum_term'][i], loan_calculation.maximum_term)
+                self.assertEqual(quotes['monthly_term'][i], loan_calculation.monthly_term)
+                self.assertEqual(quotes['monthly_payment'][i], float(loan_calculation.monthly_payment))
+
+    def test_pricing_plan(self):
+        loan_company = LoanCompany.objects.get(slug='hawaiian-institution')
+        loan_type = LoanType.objects.get(name='Used Vehicles')
+        params = {'loan_amount': 9000.00,
+                  'monthly_term': 60,
+                  'estimated_credit_score': 700,
+                  'estimated_collateral_value': 15000.00}
+        LoanCalculation(loan_company=loan_company, loan_type=loan_type, **params).calculate()
+        # Once the plan is made, pricing needs no queries
+        loan_calculation = LoanCalculation(loan_company=loan_company, loan_type=loan_type, **params)
+        with self.assertNumQueries(0):
+            loan_calculation.calculate()
+            quotes = batch_quote(loan_company, loan_type, **params)
+        self.assertEqual(quotes['rate'], loan_calculation.rate)
+        self.assertEqual(quotes['maximum_term'], loan_calculation.maximum_term)
+
+        # and changing an addition type makes it again
+        value_type = LoanAdditionType.objects.filter(loan_company=loan_company, loan_type=loan_type,
+                                                     sum_in_rate_calculation=True).first()
+        value_type.sum_in_rate_calculation = False
+        value_type.save()
+        plan = loan_calculation.pricing_plan
+        self.assertNotIn(value_type.pk, [addition.value_type_id for addition in plan.rate_additions])
+
+    def test_incremental_calculation(self):
+        """
+        A saved calculation loaded again must redo only the lookups that depend on the inputs changed since, and
+        come out as a calculation made from scratch.
+        """
+        loan_company = LoanCompany.objects.get(slug='hawaiian-institution')
+        loan_type = LoanType.objects.get(name='Used Vehicles')
+        saved = LoanCalculation(loan_company=loan_company, loan_type=loan_type,
+                                loan_amount=Decimal('9000.00'),
+                                estimated_credit_score=700,
+                                estimated_collateral_value=Decimal('15000.00'))
+        saved.save()
+        record = json.dumps(saved.get_record(), cls=MoneyJSONEncoder)
+
+        def check(loan_calculation, changes, looked_up):
+            for (name, value) in changes.items():
+                setattr(loan_calculation, name, value)
+            with mock.patch.object(RateTable, 'lookup', autospec=True, side_effect=RateTable.lookup) as lookup:
+                loan_calculation.calculate()
+            self.assertEqual(lookup.called, looked_up)
+            fresh = LoanCalculation(loan_company=loan_company, loan_type=loan_type,
+                                    **{name: getattr(loan_calculation, name)
+                                       for name in LoanCalculation.CALCULATION_INPUTS})
+            fresh.calculate()
+            for name in ('rate', 'maximum_term', 'monthly_term', 'current_loan_estimated_remaining_term',
+                         'monthly_payment'):
+                self.assertEqual(getattr(loan_calculation, name), getattr(fresh, name))
+
+        for (changes, looked_up) in [({'monthly_term': 36}, False),
+                                     ({'current_loan_balance': Decimal('6000.00'),
+                                       'current_loan_monthly_payment': Decimal('300.00'),
+                                       'current_loan_rate': 0.15}, False),
+                                     ({'loan_amount': Decimal('14000.00')}, True),
+                                     ({'estimated_collateral_value': Decimal('30000.00')}, True),
+                                     # (no table of this plan is indexed on it)
+                                     ({'estimated_year_of_collateral': 1990}, False),
+                                     ({'estimated_credit_score': 640, 'monthly_term': 36}, True)]:
+            check(LoanCalculation.objects.get(pk=saved.pk), changes, looked_up)
+            # as does one kept in the session
+            check(LoanCalculation.from_record(json.loads(record)), changes, looked_up)
+
+        # The stored results are not reused once the pricing plan has changed
+        addition = LoanAddition.objects.filter(loan_company=loan_company, loan_type=loan_type).first()
+        addition.value += 0.01
+        addition.save()
+        addition.value_type.rate_table_changed()
+        check(LoanCalculation.objects.get(pk=saved.pk), {'monthly_term': 36}, True)
+
+    def test_maximum_loan_amounts(self):
+        loan_company = LoanCompany.objects.get(slug='hawaiian-institution')
+        monthly_terms = [12, 36, 60, 84]
+        for loan_type in LoanType.objects.filter(name__in=['Used Vehicles', 'New Vehicles']):
+            for credit_score in (300, 649, 650, 850):
+                quotes = maximum_loan_amounts(loan_company, loan_type, 300.00, monthly_terms,
+                                              estimated_credit_score=credit_score,
+                                              estimated_collateral_value=15000.00)
+                # A dollar by dollar search must not find anything larger
+                loan_amounts = np.arange(1.0, 40000.0)
+                for (i, monthly_term) in enumerate(monthly_terms):
+                    scan = batch_quote(loan_company, loan_type, loan_amounts, monthly_term,
+                                       estimated_credit_score=credit_score,
+                                       estimated_collateral_value=15000.00)
+                    affordable = (scan['rate'] >= 0) & (scan['monthly_payment'] <= 300.00)
+                    if not affordable.any():
+                        self.assertTrue(np.isnan(quotes['loan_amount'][i]))
+                        continue
+                    self.assertGreaterEqual(quotes['loan_amount'][i], loan_amounts[affordable].max())
+                    self.assertLessEqual(quotes['monthly_payment'][i], 300.00)
+
+                    # and a cent more must not be affordable
+                    more = batch_quote(loan_company, loan_type, quotes['loan_amount'][i] + 0.01, monthly_term,
+                                       estimated_credit_score=credit_score,
+                                       estimated_collateral_value=15000.00)
+                    self.assertFalse(more['rate'] >= 0 and more['monthly_payment'] <= 300.00)
+
+    def test_compare_loan_companies(self):
+        for loan_type in LoanType.objects.filter(name__in=['Used Vehicles', 'New Vehicles']):
+            for order_by in ('monthly_payment', 'total_interest'):
+                quotes = compare_loan_companies(loan_type, 9000.00, 60,
+                                                estimated_credit_score=700,
+                                                estimated_collateral_value=15000.00,
+                                                order_by=order_by)
+                ranking = [quote[order_by] for quote in quotes if quote['rate'] >= 0]
+                self.assertEqual(ranking, sorted(ranking))
+                for quote in quotes:
+                    batch = batch_quote(quote['loan_company'], loan_type, 9000.00, 60,
+                                        estimated_credit_score=700,
+                                        estimated_collateral_value=15000.00)
+                    self.assertEqual(quote['rate'], batch['rate'])
+                    self.assertEqual(quote['maximum_term'], batch['maximum_term'])
+                    if quote['rate'] >= 0:
+                        self.assertEqual(quote['monthly_payment'], batch['monthly_payment'])
+
+        # A company with an empty table is left out rather than failing the comparison
+        loan_type = LoanType.objects.get(name='Used Vehicles')
+        value_type = LoanAdditionType.objects.filter(loan_company__slug='wyoming-institution',
+                                                     loan_type=loan_type).first()
+        LoanAddition.delete_table(value_type.pk)
+        value_type.rate_table_changed()
+        quotes = compare_loan_companies(loan_type, 9000.00, 60, estimated_credit_score=700,
+                                        estimated_collateral_value=15000.00)
+        self.assertEqual([quote['loan_company'].slug for quote in quotes], ['hawaiian-institution'])
+
+
+class TestSpool(TestCase):
+    fixtures = ['test_loancompanies.json',
+                'test_loantypes.json',
+                'test_loanadditiontypes.json',
+                'test_loanadditions.json']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spool.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_spool(self):
+        written = []
+        spool = Spool(self.path, written.append, batch_size=3, flush_interval=None, max_pending=5,
+                      encoder=MoneyJSONEncoder)
+        self.assertEqual([spool.put({'n': n, 'amount': Money(n)}) for n in range(6)], [True] * 5 + [False])
+        self.assertEqual(spool.flush(), 3)
+        self.assertEqual(written, [[{'n': n, 'amount': str(Money(n))} for n in range(3)]])
+        self.assertEqual(spool.flush_all(), 2)
+        self.assertEqual([record['n'] for record in written[1]], [3, 4])
+        self.assertEqual(spool.pending(), 0)
+
+        # The records stay until they are written
+        def fail(records):
+            raise IOError
+        spool = Spool(self.path, fail, flush_interval=None)
+        spool.put({'n': 6})
+        self.assertRaises(IOError, spool.flush)
+        spool.writer = written.append
+        self.assertEqual(spool.flush_all(), 1)
+
+        # Records can be added while a batch is being written, and another flush leaves the batch alone
+        def write(records):
+            self.assertEqual(Spool(self.path, fail, flush_interval=None).flush(), 0)
+            adding = threading.Thread(target=lambda: Spool(self.path, fail, flush_interval=None).put({'n': 8}))
+            adding.start()
+            adding.join(5)
+            self.assertFalse(adding.is_alive())
+            written.append(records)
+        spool.writer = write
+        spool.put({'n': 7})
+        self.assertEqual(spool.flush(), 1)
+        self.assertEqual(written[-1], [{'n': 7}])
+        self.assertEqual(spool.pending(), 1)
+
+    def test_write_behind(self):
+        calculation = LoanCalculation(loan_company=LoanCompany.objects.get(slug='hawaiian-institution'),
+                                      loan_type=LoanType.objects.get(name='Used Vehicles'),
+                                      loan_amount=Decimal('9000.00'),
+                                      estimated_collateral_value=Decimal('15000.00'))
+        calculation.calculate()
+        spool = lcmodels.calculation_spool
+        lcmodels.calculation_spool = Spool(self.path, lcmodels.write_spooled_calculations, flush_interval=None,
+                                           encoder=MoneyJSONEncoder)
+        try:
+            with self.assertNumQueries(0):
+                calculation.record()
+            self.assertIsNone(calculation.id)
+            self.assertEqual(lcmodels.calculation_spool.flush_all(), 1)
+        finally:
+            lcmodels.calculation_spool = spool
+        saved = LoanCalculation.objects.get()
+        for name in LoanCalculation.CALCULATION_INPUTS + ('rate', 'maximum_term', 'monthly_payment', 'created'):
+            self.assertEqual(getattr(saved, name), getattr(calculation, name))
+
+    def test_reuse(self):
+        def make(loan_amount):
+            return LoanCalculation(loan_company=LoanCompany.objects.get(slug='hawaiian-institution'),
+                                   loan_type=LoanType.objects.get(name='Used Vehicles'),
+                                   loan_amount=loan_amount,
+                                   estimated_collateral_value=Decimal('15000.00'))
+
+        # Calculating the same values again refers to the saved calculation
+        first = make(Decimal('9000.00'))
+        first.save()
+        again = make(9000)
+        again.save()
+        self.assertEqual(again.id, first.id)
+        self.assertEqual(again.created, first.created)
+        self.assertFalse(again.has_changed)
+        other = make(Decimal('9500.00'))
+        other.save()
+        self.assertNotEqual(other.fingerprint, first.fingerprint)
+        self.assertEqual(LoanCalculation.objects.count(), 2)
+        with override_settings(LOAN_CALCULATION_REUSE_WINDOW=None):
+            make(Decimal('9000.00')).save()
+        self.assertEqual(LoanCalculation.objects.count(), 3)
+
+        # Spooled calculations are left out when they are already saved or repeated in the batch
+        records = []
+        for loan_amount in (Decimal('9000.00'), Decimal('8000.00'), Decimal('8000.00')):
+            calculation = make(loan_amount)
+            calculation.calculate()
+            calculation.fingerprint = calculation.get_fingerprint()
+            records.append(json.loads(json.dumps(calculation.get_record(), cls=MoneyJSONEncoder)))
+        lcmodels.write_spooled_calculations(records)
+        self.assertEqual(LoanCalculation.objects.count(), 4)
+        self.assertEqual(LoanCalculation.objects.filter(loan_amount=Decimal('8000.00')).count(), 1)
+
+
+class TestCalculationView(TestCase):
+    fixtures = ['test_loancompanies.json',
+                'test_loantypes.json',
+                'test_loanadditiontypes.json',
+                'test_loanadditions.json']
+
+    def get_view(self, slug, calculation_id):
+        request = RequestFactory().get('/')
+        request.session = {'calculation_id': calculation_id}
+        return CalculationView(request=request, args=(), kwargs={'loan_company_slug': slug})
+
+    def test_lookups(self):
+        loan_company = LoanCompany.objects.get(slug='hawaiian-institution')
+        calculation = LoanCalculation(loan_company=loan_company,
+                                      loan_type=LoanType.objects.get(name='Used Vehicles'),
+                                      loan_amount=Decimal('9000.00'),
+                                      estimated_collateral_value=Decimal('15000.00'))
+        calculation.save()
+        LoanCompany.get_by_slug('hawaiian-institution')
+
+        # The loan company is cached and the calculation is one query, however often either is used
+        view = self.get_view('hawaiian-institution', calculation.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(view.get_loan_company(), loan_company)
+            self.assertEqual(view.get_calculation(), calculation)
+            self.assertEqual(view.get_calculation().loan_company, loan_company)
+            self.assertEqual(view.get_calculation().loan_type.name, 'Used Vehicles')
+            view.get_loan_company()
+
+        # A change to the company is seen
+        loan_company.email = 'quotes@example.com'
+        loan_company.save()
+        self.assertEqual(self.get_view('hawaiian-institution', None).get_loan_company().email, 'quotes@example.com')
+
+        # Another company's calculation is not used
+        other = LoanCompany.objects.exclude(pk=loan_company.pk).first()
+        self.assertIsNone(self.get_view(other.slug, calculation.pk).get_calculation())
+        self.assertRaises(Http404, self.get_view('no-such-company', None).get_loan_company)
+
+    def test_loan_type_choices(self):
+        loan_company = LoanCompany.objects.get(slug='hawaiian-institution')
+        choices = LoanCalculationForm.get_loan_type_choices(loan_company)
+        self.assertEqual(choices, [(loan_type.id, loan_type.name) for loan_type in
+                                   LoanType.objects.filter(loanaddition__loan_company=loan_company).distinct()])
+        with self.assertNumQueries(0):
+            LoanCalculationForm(loan_company=loan_company)
+
+        # A new loan type appears once it has a table, and stays when the table is packed
+        loan_type = LoanType.objects.create(name='Boats')
+        value_type = LoanAdditionType.objects.create(loan_company=loan_company, loan_type=loan_type,
+                                                     name='Maximum term')
+        self.assertNotIn((loan_type.id, 'Boats'), LoanCalculationForm.get_loan_type_choices(loan_company))
+        LoanAddition.objects.create(loan_company=loan_company, loan_type=loan_type, value_type=value_type,
+                                    credit_score=850, value_index=100, value=60)
+        value_type.rate_table_changed()
+        self.assertIn((loan_type.id, 'Boats'), LoanCalculationForm.get_loan_type_choices(loan_company))
+        LoanAdditionTable.pack_loan_additions(value_type)
+        self.assertIn((loan_type.id, 'Boats'), LoanCalculationForm.get_loan_type_choices(loan_company))
+        loan_type.name = 'Boats and Jet Skis'
+        loan_type.save()
+        self.assertIn((loan_type.id, 'Boats and Jet Skis'), LoanCalculationForm.get_loan_type_choices(loan_company))
+
+    def test_amortization_schedule(self):
+        url = '/calc/co/hawaiian-institution/calculation/schedule.csv'
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        loan_company = LoanCompany.objects.get(slug='hawaiian-institution')
+        response = self.client.post('/calc/co/hawaiian-institution/calculation/',
+                                    {'loan_company_id': loan_company.pk,
+                                     'loan_type': LoanType.objects.get(name='Used Vehicles').pk,
+                                     'loan_amount': '9000',
+                                     'monthly_term': 36,
+                                     'estimated_credit_score': 700,
+                                     'estimated_collateral_value': '15000',
+                                     'estimated_monthly_income': '5000',
+                                     'estimated_monthly_expenses': '1000',
+                                     'estimated_year_of_collateral': 2014})
+        self.assertEqual(response.status_code, 302)
+        calculation = LoanCalculation.objects.get()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="payment_schedule_{}.csv"'.format(calculation.id))
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+        self.assertEqual(rows[0], ['Month', 'Payment', 'Interest', 'Principal', 'Balance'])
+        self.assertEqual(len(rows), 37)
+        self.assertEqual(rows[1][1], str(calculation.monthly_payment))
+        self.assertEqual(rows[-1][-1], '0.00')
+        # Another company has no calculation in the session
+        self.assertEqual(self.client.get('/calc/co/wyoming-institution/calculation/schedule.csv').status_code, 404)
+
+        # A disqualified calculation has no payments
+        calculation = LoanCalculation(loan_company=LoanCompany.objects.get(slug='wyoming-institution'),
+                                      loan_type=LoanType.objects.get(name='Used Vehicles'),
+                                      loan_amount=Decimal('9000.00'),
+                                      estimated_credit_score=300,
+                                      estimated_collateral_value=Decimal('15000.00'))
+        calculation.calculate()
+        self.assertTrue(calculation.disqualified)
+        request = RequestFactory().get('/')
+        request.session = {'calculation': json.dumps(calculation.get_record(), cls=MoneyJSONEncoder)}
+        response = AmortizationScheduleView.as_view()(request, loan_company_slug='wyoming-institution')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'Month,Payment,Interest,Principal,Balance\r\n')
+
+
+class TestQuoteViews(TestCase):
+    """
+    The JSON endpoints, through the test client.
+    """
+    fixtures = ['test_loancompanies.json',
+                'test_loantypes.json',
+                'test_loanadditiontypes.json',
+                'test_loanadditions.json']
+    profile = {'loan_type': 1,
+               'loan_amount': '9000',
+               'monthly_term': 36,
+               'estimated_collateral_value': '15000'}
+
+    def get_json(self, url, status, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_quote(self):
+        url = '/calc/co/hawaiian-institution/quote.json'
+        quote = self.get_json(url, 200, **self.profile)
+        self.assertTrue(quote['qualified'])
+        self.assertEqual(quote['rate'], 0.0275)
+        self.assertEqual(quote['monthly_payment'], '260.74')
+        self.assertEqual(quote['loan_interest'], '386.64')
+        self.assertIsNone(quote['estimated_monthly_savings'])
+        self.assertFalse(LoanCalculation.objects.exists())
+
+        # Disqualified quotes have no rate, payment or anything worked out from them
+        disqualified = dict(self.profile, estimated_credit_score=300, current_loan_balance='5000',
+                            current_loan_monthly_payment='300', current_loan_rate='6%')
+        quote = self.get_json('/calc/co/wyoming-institution/quote.json', 200, **disqualified)
+        self.assertFalse(quote['qualified'])
+        self.assertEqual(quote['current_loan_estimated_remaining_term'], 17)
+        for name in ('rate', 'monthly_payment', 'apr', 'estimated_monthly_savings', 'estimated_yearly_savings',
+                     'loan_interest', 'interest_savings'):
+            self.assertIsNone(quote[name])
+
+        errors = self.get_json(url, 400, loan_type=1, monthly_term=36)['errors']
+        self.assertEqual(list(errors), ['loan_amount'])
+        errors = self.get_json(url, 400, **dict(self.profile, loan_amount='lots'))['errors']
+        self.assertEqual(list(errors), ['loan_amount'])
+        errors = self.get_json(url, 400, **dict(self.profile, estimated_collateral_value='0'))['errors']
+        self.assertEqual(list(errors), ['estimated_collateral_value'])
+        # The loan company has no tables for HELOCs
+        errors = self.get_json(url, 400, **dict(self.profile, loan_type=7))['errors']
+        self.assertEqual(list(errors), ['loan_type'])
+
+    def test_quote_grid(self):
+        url = '/calc/co/hawaiian-institution/quote_grid.json'
+        params = dict(self.profile, loan_amount=['9000', '20000', '90000'], monthly_term=[36, 60])
+        grid = self.get_json(url, 200, **params)
+        self.assertEqual(grid['loan_amounts'], ['9000', '20000', '90000'])
+        self.assertEqual(grid['monthly_terms'], [36, 60])
+        self.assertEqual(grid['monthly_payment'][0], [260.74, 160.72])
+        self.assertEqual([len(row) for row in grid['rate']], [2, 2, 2])
+
+        # Disqualified rows have no rate or payment
+        grid = self.get_json('/calc/co/wyoming-institution/quote_grid.json', 200,
+                             **dict(params, estimated_credit_score=300))
+        for name in ('rate', 'monthly_payment', 'apr'):
+            self.assertEqual(grid[name], [[None, None]] * 3)
+        self.assertEqual(grid['monthly_term'], [[36, 60]] * 3)
+
+        errors = self.get_json(url, 400, **dict(params, loan_amount=[]))['errors']
+        self.assertEqual(list(errors), ['loan_amount'])
+        errors = self.get_json(url, 400, **dict(params, monthly_term=['36', 'long']))['errors']
+        self.assertEqual(list(errors), ['monthly_term'])
+        errors = self.get_json(url, 400, **dict(params, monthly_term=list(range(1, 62))))['errors']
+        self.assertEqual(list(errors), ['monthly_term'])
+        errors = self.get_json(url, 400, **dict(params, loan_type=7))['errors']
+        self.assertEqual(list(errors), ['loan_type'])
+
+    def test_affordability(self):
+        url = '/calc/co/hawaiian-institution/affordability.json'
+        params = dict(self.profile, monthly_payment='300', monthly_term=[36, 60])
+        del params['loan_amount']
+        quotes = self.get_json(url, 200, **params)
+        self.assertEqual(quotes['budget'], '300')
+        self.assertEqual(quotes['monthly_terms'], [36, 60])
+        self.assertEqual(quotes['loan_amount'], [10355.29, 16799.65])
+        self.assertEqual(quotes['monthly_term'], [36, 60])
+        self.assertTrue(all(payment <= 300 for payment in quotes['monthly_payments']))
+
+        # Nothing is affordable when disqualified
+        quotes = self.get_json('/calc/co/wyoming-institution/affordability.json', 200,
+                               **dict(params, estimated_credit_score=300))
+        self.assertEqual(quotes['budget'], '300')
+        for name in ('loan_amount', 'rate', 'monthly_payments', 'apr'):
+            self.assertEqual(quotes[name], [None, None])
+
+        errors = self.get_json(url, 400, **dict(params, monthly_payment=''))['errors']
+        self.assertEqual(list(errors), ['monthly_payment'])
+        errors = self.get_json(url, 400, **dict(params, monthly_payment='-3'))['errors']
+        self.assertEqual(list(errors), ['monthly_payment'])
+        errors = self.get_json(url, 400, **dict(params, monthly_term=[]))['errors']
+        self.assertEqual(list(errors), ['monthly_term'])
+        errors = self.get_json(url, 400, **dict(params, loan_type=7))['errors']
+        self.assertEqual(list(errors), ['loan_type'])
+
+    def test_loan_comparison(self):
+        url = '/calc/compare.json'
+        comparison = self.get_json(url, 200, **self.profile)
+        self.assertEqual(comparison['loan_type'], 'Used Vehicles')
+        self.assertEqual([quote['loan_company_slug'] for quote in comparison['quotes']],
+                         ['hawaiian-institution', 'wyoming-institution'])
+        self.assertEqual([quote['monthly_payment'] for quote in comparison['quotes']], [260.74, 266.72])
+
+        # The disqualified quotes come last, with no rate or payment
+        comparison = self.get_json(url, 200, **dict(self.profile, estimated_credit_score=300))
+        quote = comparison['quotes'][-1]
+        self.assertEqual(quote['loan_company_slug'], 'wyoming-institution')
+        self.assertFalse(quote['qualified'])
+        for name in ('rate', 'monthly_payment', 'apr', 'total_interest'):
+            self.assertIsNone(quote[name])
+        self.assertTrue(comparison['quotes'][0]['qualified'])
+
+        errors = self.get_json(url, 400, loan_amount='9000')['errors']
+        self.assertEqual(list(errors), ['loan_type'])
+        errors = self.get_json(url, 400, **dict(self.profile, order_by='rate'))['errors']
+        self.assertEqual(list(errors), ['order_by'])
+        errors = self.get_json(url, 400, **dict(self.profile, monthly_term='long'))['errors']
+        self.assertEqual(list(errors), ['monthly_term'])
+
+
+class TestLoanDataImporter(TestCase):
+    example_filename = os.path.join(os.path.dirname(__file__), 'import_csv', 'loan_data_example.csv')
+
+    @staticmethod
+    def get_loan_additions():
+        return sorted(LoanAddition.objects.values_list('loan_company__title',
+                                                       'loan_type__name',
+                                                       'value_type__name',
+                                                       'credit_score',
+                                                       'value_index',
+                                                       'value'))
+
+    def test_bulk_import(self):
+        """
+        The bulk import must give the same values as the row by row import, and replace them when repeated.
+        """
+        with open(self.example_filename, 'rt') as csv_file:
+            LoanDataImporter().import_file(csv_file)
+        expected = self.get_loan_additions()
+        self.assertTrue(expected)
+
+        importer = LoanDataImporter(bulk=True)
+        for _ in range(2):
+            with open(self.example_filename, 'rt') as csv_file:
+                importer.import_file(csv_file)
+            self.assertEqual(self.get_loan_additions(), expected)
+        self.assertEqual(importer.rows_imported, 2 * len(expected))
+
+        # A table is deleted without loading its rows
+        value_type = LoanAdditionType.objects.filter(loanaddition__isnull=False)[0]
+        with self.assertNumQueries(1):
+            LoanAddition.delete_table(value_type.pk)
+        self.assertFalse(LoanAddition.objects.filter(value_type=value_type).exists())
+        self.assertTrue(LoanAddition.objects.exists())
+
+    def test_unknown_type(self):
+        csv_file = io.StringIO('LoanCompany_title,LoanType_name,LoanAdditionLookupValueType,Type,credit_score,vi1\n'
+                               'Hawaiian Institution,Used Vehicles,Maximum term,value_index,,0\n'
+                               'Hawaiian Institution,Used Vehicles,Maximum term,valeus,0,60\n')
+        with self.assertRaises(LoanDataImportError):
+            LoanDataImporter(bulk=True).import_file(csv_file)
+        self.assertFalse(LoanAddition.objects.exists())
+
+    def test_incremental_import(self):
+        with open(self.example_filename, 'rt') as csv_file:
+            lines = csv_file.read().splitlines(True)
+        importer = LoanDataImporter(incremental=True)
+        importer.import_file(io.StringIO(''.join(lines)))
+        tables = importer.tables_imported
+        expected = self.get_loan_additions()
+
+        importer = LoanDataImporter(incremental=True)
+        importer.import_file(io.StringIO(''.join(lines)))
+        self.assertEqual((importer.tables_imported, importer.tables_skipped), (0, tables))
+        self.assertEqual(self.get_loan_additions(), expected)
+
+        # Change the first value of the first table
+        fields = lines[2].split(',')
+        fields[5] = '72'
+        lines[2] = ','.join(fields)
+        importer = LoanDataImporter(incremental=True)
+        importer.import_file(io.StringIO(''.join(lines)))
+        self.assertEqual(importer.changed_tables, [tuple(fields[:3])])
+        self.assertEqual(importer.tables_skipped, tables - 1)
+
+        # The row by row import does not keep checksums, and forgets the old ones a table at a time
+        LoanDataImporter().import_file(io.StringIO(''.join(lines)))
+        importer = LoanDataImporter(incremental=True)
+        importer.import_file(io.StringIO(''.join(lines)))
+        self.assertEqual((importer.tables_imported, importer.tables_skipped), (tables, 0))
+
+    def test_import_files(self):
+        """
+        Importing the example split into two files in parallel must give the same values as importing it whole.
+        """
+        with open(self.example_filename, 'rt') as csv_file:
+            LoanDataImporter(bulk=True).import_file(csv_file)
+        expected = self.get_loan_additions()
+
+        with open(self.example_filename, 'rt') as csv_file:
+            lines = csv_file.read().splitlines(True)
+        middle = next(i for i in range(len(lines) // 2, len(lines)) if ',value_index,' in lines[i])
+        folder = tempfile.mkdtemp()
+        try:
+            csv_filenames = [os.path.join(folder, name) for name in ('first.csv', 'second.csv', 'bad.csv')]
+            for (csv_filename, file_lines) in zip(csv_filenames, (lines[:middle],
+                                                                  lines[:1] + lines[middle:],
+                                                                  lines[:1] + ['a,b,c,valeus,0,60\n'])):
+                with open(csv_filename, 'wt') as csv_file:
+                    csv_file.writelines(file_lines)
+
+            LoanAddition.objects.all().delete()
+            importer = LoanDataImporter()
+            errors = importer.import_files(csv_filenames, processes=2)
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(list(errors), [csv_filenames[2]])
+        self.assertEqual(importer.files_imported, 2)
+        self.assertEqual(self.get_loan_additions(), expected)
+
+    def test_packed_import(self):
+        """
+        Packed tables must compile to the same rate tables as the rows they replace, and unpack to the same rows.
+        """
+        with open(self.example_filename, 'rt') as csv_file:
+            LoanDataImporter(bulk=True).import_file(csv_file)
+        expected = self.get_loan_additions()
+        keys = set(LoanAddition.objects.values_list('loan_company_id', 'loan_type_id'))
+        compiled = {key: load_rate_tables(*key) for key in keys}
+
+        with open(self.example_filename, 'rt') as csv_file:
+            LoanDataImporter(packed=True).import_file(csv_file)
+        self.assertFalse(LoanAddition.objects.exists())
+        self.assertEqual(LoanAdditionTable.objects.count(), LoanAdditionType.objects.count())
+        for key in keys:
+            tables = load_rate_tables(*key)
+            self.assertEqual(set(tables), set(compiled[key]))
+            for (value_type_id, table) in tables.items():
+                self.assertEqual(list(table.credit_scores), compiled[key][value_type_id].credit_scores)
+                self.assertEqual(list(table.value_indices), compiled[key][value_type_id].value_indices)
+                np.testing.assert_array_equal(table.arrays[2], compiled[key][value_type_id].arrays[2])
+
+        for packed in LoanAdditionTable.objects.all():
+            packed.unpack()
+        self.assertEqual(self.get_loan_additions(), expected)
+        for value_type in LoanAdditionType.objects.all():
+            LoanAdditionTable.pack_loan_additions(value_type)
+        self.assertFalse(LoanAddition.objects.exists())
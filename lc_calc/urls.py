@@ -5,4 +5,11 @@ import lc_calc.views as views
 urlpatterns = patterns(
     '',
     url("^co/(?P<loan_company_slug>.*)/calculation/$", views.CalculationView.as_view(), name="calculation"),
-    url("^co/(?P<loan_company_slug>.*)/contact/$", views.LoanCompanyMessageView.as_view(), name="loan_company_message"))
\ No newline at end of file
+    url("^co/(?P<loan_company_slug>.*)/calculation/schedule\.csv$", views.AmortizationScheduleView.as_view(),
+        name="amortization_schedule"),
+    url("^co/(?P<loan_company_slug>.*)/contact/$", views.LoanCompanyMessageView.as_view(), name="loan_company_message"),
+    url("^co/(?P<loan_company_slug>.*)/quote\.json$", views.QuoteView.as_view(), name="quote"),
+    url("^co/(?P<loan_company_slug>.*)/quote_grid\.json$", views.QuoteGridView.as_view(), name="quote_grid"),
+    url("^co/(?P<loan_company_slug>.*)/affordability\.json$", views.AffordabilityView.as_view(),
+        name="affordability"),
+    url("^compare\.json$", views.LoanComparisonView.as_view(), name="loan_comparison"))
\ No newline at end of file
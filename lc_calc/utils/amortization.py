@@ -0,0 +1,53 @@
+"""
+Month by month amortization schedules.
+
+The schedule is generated a period at a time and worked in whole cents: each period's interest is the
+balance times the monthly rate rounded (half up) to the cent, the rest of the payment goes to the principal,
+and the last payment is adjusted to pay off exactly what is left.
+"""
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+from lc_calc.utils.money import Money
+
+AmortizationPeriod = namedtuple('AmortizationPeriod', ['period', 'payment', 'interest', 'principal', 'balance'])
+
+ONE = Decimal(1)
+
+
+def _to_cents(amount):
+    if isinstance(amount, Money):
+        return amount.cents
+    return int((Decimal(amount) * 100).quantize(ONE, ROUND_HALF_UP))
+
+
+def _to_dollars(cents):
+    return Decimal(cents).scaleb(-2)
+
+
+def amortization_schedule(loan_amount, annual_rate, nperiods, monthly_payment):
+    """
+    Generate an AmortizationPeriod (period, payment, interest, principal, balance) for each month of a loan.
+    The amounts are Decimal dollars (loan_amount and monthly_payment may also be Money).
+    - loan_amount: The amount borrowed
+    - annual_rate: The annual interest rate (paid monthly)
+    - nperiods: The number of months
+    - monthly_payment: The regular payment
+    """
+    balance = _to_cents(loan_amount)
+    payment = _to_cents(monthly_payment)
+    monthly_rate = Decimal(str(annual_rate)) / 12
+    for period in range(1, int(nperiods) + 1):
+        interest = int((balance * monthly_rate).quantize(ONE, ROUND_HALF_UP))
+        if period == nperiods or payment - interest >= balance:
+            principal = balance
+        else:
+            principal = payment - interest
+        balance -= principal
+        yield AmortizationPeriod(period,
+                                 _to_dollars(principal + interest),
+                                 _to_dollars(interest),
+                                 _to_dollars(principal),
+                                 _to_dollars(balance))
+        if balance == 0:
+            break
@@ -28,28 +28,57 @@ The fv, pv, pmt, nper and rate variables are explained in Excel's Help on PV.
 Functions like ipmt are variations on the above, as also described in Excel's
 Help file.
 """
-from math import log10
+import numpy as np
 
 
-def nper(rate, pmt, pv):
+def _as_float_arrays(*args):
+    # The arguments may be scalars, Decimals or sequences
+    return [np.asarray(arg, dtype=float) for arg in args]
+
+
+def _result(result):
+    # A 0-d result is returned as a scalar
+    return result[()]
+
+
+def _annuity_factor(rate, nperiods, pmt_type):
+    """
+    (1 + rate*type) * ((1 + rate)^nper - 1) / rate, which is nper where rate is 0.
+    Also returns (1 + rate)^nper.
+    """
+    growth = (1 + rate)**nperiods
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = np.where(rate == 0, nperiods, (1 + rate * pmt_type) * (growth - 1) / rate)
+    return factor, growth
+
+
+def nper(rate, pmt, pv, fv=0, pmt_type=0):
     """
     Returns the number of periods for an investment based on periodic, constant payments and a constant interest rate.
+    The arguments may be scalars or NumPy arrays (the result is an array if any of them are).
     - rate: The interest rate per period.
     - pmt: The payment made each period; it cannot change over the life of the annuity.
     Typically, pmt contains principle and interest but no other fees or taxes.
     - pv: The present value, or the lump-sum amount that a series of future payments is worth right now.
-    The future value, or a cash balance is 0.
-    Payments are assumed to be made at the end of the period.
+    - fv: The future value, or a cash balance you want to attain after the last payment is made (defaults to 0)
+    - pmt_type: 1 for payments at the beginning of the period, 0 at the end of the period (defaults to 0)
+
+    nper=-if(rate=0,(pv+fv)/pmt,(log(1+(pv+pmt*type)/pmt*rate)-log(1+(fv+pmt*type)
+/pmt*rate))/log(1+rate))
     """
-    pmt = float(pmt)  # may be a Decimal
-    pv = float(pv)  # may be a Decimal
-    rate = float(rate)  # getting paranoid
-    return log10(pmt/(pmt + pv*rate))/log10(1 + rate)
+    rate, pmt, pv, fv, pmt_type = _as_float_arrays(rate, pmt, pv, fv, pmt_type)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        adjusted_pmt = pmt * (1 + rate * pmt_type)
+        result = np.where(rate == 0,
+                          -(pv + fv) / pmt,
+                          np.log((adjusted_pmt - fv * rate) / (adjusted_pmt + pv * rate)) / np.log(1 + rate))
+    return _result(result)
 
 
 def pmt(rate, nperiods, pv, fv=0, pmt_type=0):
     """
     Returns the periodic payment for an annuity with constant interest rates.
+    The arguments may be scalars or NumPy arrays (the result is an array if any of them are).
     - rate: The interest rate per period.
     - nperiods: The number of periods in which the annuity is paid
     - pv: The present value (cash value)
@@ -59,11 +88,188 @@ def pmt(rate, nperiods, pv, fv=0, pmt_type=0):
     pmt=-if(rate=0,(pv+fv)/nper,(pv*((1+rate)^nper)+fv)/((1+rate*type)*((1+rate)^n
 per-1)/rate))
     """
-    pv = float(pv)  # may be a Decimal
-    rate = float(rate)
-    fv = float(fv)
-    if rate == 0:
-        result = (pv + fv) / nperiods
-    else:
-        result = (pv * ((1 + rate)**nperiods) + fv)/((1 + rate * pmt_type) * ((1 + rate)**nperiods - 1) / rate)
-    return - result
\ No newline at end of file
+    rate, nperiods, pv, fv, pmt_type = _as_float_arrays(rate, nperiods, pv, fv, pmt_type)
+    factor, growth = _annuity_factor(rate, nperiods, pmt_type)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = (pv * growth + fv) / factor
+    return _result(- result)
+
+
+def pv(rate, nperiods, pmt, fv=0, pmt_type=0):
+    """
+    Returns the present value of an annuity with constant payments and interest rate.
+    The arguments may be scalars or NumPy arrays (the result is an array if any of them are).
+    - rate: The interest rate per period.
+    - nperiods: The number of periods in which the annuity is paid
+    - pmt: The payment made each period
+    - fv: The future value (defaults to 0)
+    - pmt_type: 1 for payments at the beginning of the period, 0 at the end of the period (defaults to 0)
+
+    pv=-if(rate=0,pmt*nper+fv,(fv+pmt*(1+rate*type)*((1+rate)^nper-1)/rate)/((1+ra
+te)^nper))
+    """
+    rate, nperiods, pmt, fv, pmt_type = _as_float_arrays(rate, nperiods, pmt, fv, pmt_type)
+    factor, growth = _annuity_factor(rate, nperiods, pmt_type)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = (fv + pmt * factor) / growth
+    return _result(- result)
+
+
+def fv(rate, nperiods, pmt, pv=0, pmt_type=0):
+    """
+    Returns the future value of an annuity with constant payments and interest rate.
+    The arguments may be scalars or NumPy arrays (the result is an array if any of them are).
+    - rate: The interest rate per period.
+    - nperiods: The number of periods in which the annuity is paid
+    - pmt: The payment made each period
+    - pv: The present value (defaults to 0)
+    - pmt_type: 1 for payments at the beginning of the period, 0 at the end of the period (defaults to 0)
+
+    fv=-if(rate=0,pmt*nper+pv,(pv*((1+rate)^nper)+pmt*(1+rate*type)*((1+rate)^nper
+-1)/rate))
+    """
+    rate, nperiods, pmt, pv, pmt_type = _as_float_arrays(rate, nperiods, pmt, pv, pmt_type)
+    factor, growth = _annuity_factor(rate, nperiods, pmt_type)
+    result = pv * growth + pmt * factor
+    return _result(- result)
+
+
+def ipmt(rate, per, nperiods, pv, fv=0, pmt_type=0):
+    """
+    Returns the interest part of the payment for period per (1 to nperiods) of an annuity.
+    The arguments may be scalars or NumPy arrays (the result is an array if any of them are).
+    - rate: The interest rate per period.
+    - per: The period (1 is the first)
+    - nperiods: The number of periods in which the annuity is paid
+    - pv: The present value (cash value)
+    - fv: The future value (defaults to 0)
+    - pmt_type: 1 for payments at the beginning of the period, 0 at the end of the period (defaults to 0)
+
+    The interest is rate times the balance (-fv) after per-1 periods. With payments at the beginning of
+    the period there is no interest in the first period and the balance is discounted one period.
+    """
+    rate, per, nperiods, pv, fv, pmt_type = _as_float_arrays(rate, per, nperiods, pv, fv, pmt_type)
+    payment = pmt(rate, nperiods, pv, fv, pmt_type)
+    result = globals()['fv'](rate, per - 1, payment, pv, pmt_type) * rate
+    result = np.where(pmt_type == 1, result / (1 + rate), result)
+    result = np.where((pmt_type == 1) & (per == 1), 0.0, result)
+    return _result(np.asarray(result))
+
+
+def ppmt(rate, per, nperiods, pv, fv=0, pmt_type=0):
+    """
+    Returns the principal part of the payment for period per (1 to nperiods) of an annuity.
+    The arguments are as for ipmt.
+    """
+    payment = pmt(rate, nperiods, pv, fv, pmt_type)
+    return _result(np.asarray(payment - ipmt(rate, per, nperiods, pv, fv, pmt_type)))
+
+
+def cumipmt(rate, nperiods, pv, start_period, end_period, pmt_type=0):
+    """
+    Returns the total interest paid from start_period to end_period (inclusive, 1 is the first period).
+    The arguments may be scalars or NumPy arrays (the result is an array if any of them are).
+    - rate: The interest rate per period.
+    - nperiods: The number of periods in which the annuity is paid
+    - pv: The present value (cash value)
+    - start_period: The first period to include
+    - end_period: The last period to include
+    - pmt_type: 1 for payments at the beginning of the period, 0 at the end of the period (defaults to 0)
+
+    The payments in the range less the principal they pay off, that being the change in the balance (-fv)
+    from before the payment in start_period to after the payment in end_period.
+    """
+    rate, nperiods, pv, start_period, end_period, pmt_type = _as_float_arrays(
+        rate, nperiods, pv, start_period, end_period, pmt_type)
+    payment = pmt(rate, nperiods, pv, 0, pmt_type)
+    balance_before = -fv(rate, start_period - 1, payment, pv, pmt_type)
+    balance_after = -fv(rate, end_period, payment, pv, pmt_type)
+    # Paying at the beginning of the period, a balance includes a period of interest the next payment pays
+    balance_before = np.where(pmt_type == 1,
+                              np.where(start_period == 1, pv, balance_before / (1 + rate)),
+                              balance_before)
+    balance_after = np.where(pmt_type == 1, balance_after / (1 + rate), balance_after)
+    return _result(np.asarray(payment * (end_period - start_period + 1) + balance_before - balance_after))
+
+
+def rate(nperiods, pmt, pv, fv=0, pmt_type=0, guess=0.1, tol=1e-10, maxiter=100, full_output=False):
+    """
+    Returns the interest rate per period of an annuity, solved by iteration.
+    The arguments may be scalars or NumPy arrays (the result is an array if any of them are).
+    - nperiods: The number of periods in which the annuity is paid
+    - pmt: The payment made each period
+    - pv: The present value (cash value)
+    - fv: The future value (defaults to 0)
+    - pmt_type: 1 for payments at the beginning of the period, 0 at the end of the period (defaults to 0)
+    - guess: The starting rate (defaults to 0.1)
+    - tol: Convergence is when a step changes the rate by less than tol * (1 + |rate|)
+    - maxiter: The maximum number of iterations
+    - full_output: If true, returns (rate, failed) where failed is true for the elements that did not converge
+
+    Elements that do not converge are NaN, as are those with no root found between -100% and the bracket's
+    widest rate (a Newton iteration from the guess alone could settle anywhere). Each iteration takes a Newton
+    step on pv*(1+rate)^nper + pmt*(1+rate*type)*((1+rate)^nper-1)/rate + fv = 0, falling back to bisecting the
+    bracket around the root where the Newton step would leave it or is not at least halving the step size.
+    """
+    nperiods, pmt, pv, fv, pmt_type, guess = np.broadcast_arrays(
+        *_as_float_arrays(nperiods, pmt, pv, fv, pmt_type, guess))
+
+    def residual(rate):
+        factor, growth = _annuity_factor(rate, nperiods, pmt_type)
+        return pv * growth + pmt * factor + fv
+
+    # Bracket the root between a rate just above -100% and one high enough to change the sign
+    low = np.full(nperiods.shape, -1 + 1e-6)
+    high = np.ones(nperiods.shape)
+    with np.errstate(over='ignore', invalid='ignore'):
+        low_residual = residual(low)
+        high_residual = residual(high)
+        for _ in range(10):
+            unbracketed = np.sign(low_residual) == np.sign(high_residual)
+            if not unbracketed.any():
+                break
+            high = np.where(unbracketed, high * 4, high)
+            high_residual = residual(high)
+    unsolvable = np.isnan(low_residual) | np.isnan(high_residual)
+    bracketed = (np.sign(low_residual) != np.sign(high_residual)) & ~unsolvable
+
+    result = np.where((guess > low) & (guess < high), guess, (low + high) / 2)
+    previous_step = high - low
+    converged = unsolvable.copy()
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(maxiter):
+            value = residual(result)
+            # Narrow the bracket to the side of the root the current rate is on
+            below = np.sign(value) == np.sign(low_residual)
+            low = np.where(bracketed & below, result, low)
+            high = np.where(bracketed & ~below, result, high)
+
+            # d/drate of the residual (the annuity factor term by parts)
+            growth = (1 + result)**nperiods
+            d_growth = nperiods * (1 + result)**(nperiods - 1)
+            d_factor = (pmt_type * (growth - 1) / result +
+                        (1 + result * pmt_type) * (d_growth * result - (growth - 1)) / result**2)
+            step = value / (pv * d_growth + pmt * d_factor)
+            newton = result - step
+            use_newton = np.isfinite(newton) & (~bracketed | ((newton > low) & (newton < high) &
+                                                              (np.abs(step) <= np.abs(previous_step) / 2)))
+            following = np.where(use_newton, newton, (low + high) / 2)
+            following = np.where(converged, result, following)
+            previous_step = following - result
+
+            converged |= np.abs(following - result) <= tol * (1 + np.abs(result))
+            result = following
+            if converged.all():
+                break
+
+        # Near 0 the residual is a difference of nearly equal terms, so a root there is only found to about
+        # 1e-10: take 0 exactly where it solves the equation to within tol
+        zero_solves = (np.abs(pv + pmt * nperiods + fv) <=
+                       tol * (np.abs(pv) + np.abs(pmt * nperiods) + np.abs(fv)))
+        result = np.where((np.abs(result) < 1e-6) & zero_solves, 0.0, result)
+
+    failed = unsolvable | ~bracketed | ~converged | ~np.isfinite(result) | ~(result > -1)
+    result = np.where(failed, np.nan, result)
+    if full_output:
+        return _result(result), _result(failed)
+    return _result(result)
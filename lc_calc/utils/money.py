@@ -0,0 +1,162 @@
+"""
+Amounts of money as whole numbers of cents.
+
+A Money is converted from a Decimal, float or string once, when it is loaded or assigned, rounding to the cent as
+Decimal.quantize(Decimal('0.01')) does. Sums, differences and multiples by whole numbers are then integer
+arithmetic (an int being whole dollars, so that sum() stays Money), and it only becomes a Decimal again to be
+stored. Money compares with Decimals, ints and floats as its Decimal does, exactly (so it equals only a float that is
+exactly the amount, such as 0.5, and not the float nearest it), hashes as the Decimal does, and prints as dollars with
+two decimal places.
+"""
+import datetime
+from decimal import Decimal
+import functools
+import numbers
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+def _cents_from_decimal(value):
+    return int(value.scaleb(2).to_integral_value())
+
+
+@functools.total_ordering
+class Money(object):
+    """
+    An immutable amount of money: cents is a whole number of cents.
+    """
+    __slots__ = ('cents',)
+
+    def __init__(self, cents):
+        self.cents = int(cents)
+
+    @classmethod
+    def from_decimal(cls, value):
+        return cls(_cents_from_decimal(value))
+
+    @classmethod
+    def from_float(cls, value):
+        scaled = value * 100
+        cents = round(scaled)
+        # value * 100 is itself rounded, so near half a cent only the exact decimal rounding is reliable
+        if abs(abs(scaled - cents) - 0.5) < 1e-6:
+            return cls.from_decimal(Decimal(float(value)))
+        return cls(cents)
+
+    @classmethod
+    def from_value(cls, value):
+        """
+        Convert a Money, Decimal, float, int or string of dollars (None stays None).
+        """
+        if value is None or isinstance(value, Money):
+            return value
+        if isinstance(value, float):
+            return cls.from_float(value)
+        if isinstance(value, numbers.Integral):
+            return cls(value * 100)
+        if not isinstance(value, Decimal):
+            value = Decimal(value)
+        return cls.from_decimal(value)
+
+    def to_decimal(self):
+        return Decimal(self.cents).scaleb(-2)
+
+    def __float__(self):
+        return self.cents / 100
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __str__(self):
+        return '{}{}.{:02d}'.format('-' if self.cents < 0 else '', *divmod(abs(self.cents), 100))
+
+    def __repr__(self):
+        return "Money('{}')".format(self)
+
+    def __format__(self, format_spec):
+        return format(self.to_decimal(), format_spec)
+
+    def __hash__(self):
+        return hash(self.to_decimal())
+
+    def __round__(self, ndigits=None):
+        return round(float(self), ndigits)
+
+    def _compare(self, other):
+        # (a, b) to compare in place of (self, other)
+        if isinstance(other, Money):
+            return self.cents, other.cents
+        if isinstance(other, numbers.Integral):
+            return self.cents, other * 100
+        if isinstance(other, (Decimal, float)):
+            return self.to_decimal(), other
+        return None
+
+    def __eq__(self, other):
+        pair = self._compare(other)
+        return NotImplemented if pair is None else pair[0] == pair[1]
+
+    def __lt__(self, other):
+        pair = self._compare(other)
+        return NotImplemented if pair is None else pair[0] < pair[1]
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return Money(abs(self.cents))
+
+    def __add__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents + other.cents)
+        if isinstance(other, numbers.Integral):
+            return Money(self.cents + other * 100)
+        if isinstance(other, float):
+            return float(self) + other
+        if isinstance(other, Decimal):
+            return self.to_decimal() + other
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self + -other if isinstance(other, (Money, numbers.Number)) else NotImplemented
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, other):
+        if isinstance(other, numbers.Integral):
+            return Money(self.cents * other)
+        if isinstance(other, float):
+            return float(self) * other
+        if isinstance(other, Decimal):
+            return self.to_decimal() * other
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, Money):
+            other = other.to_decimal()
+        elif isinstance(other, float):
+            return float(self) / other
+        elif not isinstance(other, (numbers.Integral, Decimal)):
+            return NotImplemented
+        return self.to_decimal() / other
+
+
+class MoneyJSONEncoder(DjangoJSONEncoder):
+    """
+    Encodes Money as a string of dollars, as DjangoJSONEncoder does Decimals, and datetimes to the microsecond
+    (rather than the millisecond) so that they decode to the same datetime.
+    """
+    def default(self, o):
+        if isinstance(o, Money):
+            return str(o)
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
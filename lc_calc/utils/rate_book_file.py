@@ -0,0 +1,119 @@
+"""
+Compiled rate book files.
+
+A rate book file holds the compiled tables of any number of (loan_company, loan_type) snapshots so that every
+worker process can memory map the same file rather than each compiling and keeping its own copy:
+
+- a 16 byte header: the magic bytes and the length of the index
+- the index: JSON listing each snapshot's ids, version and tables, with the offset and shape of each table
+- the tables, 8 byte aligned: the credit scores, value indices and values of each as little endian doubles
+
+Identical tables are written once, with every index entry for them pointing at the same block, and are read as
+NumPy views of the mapped file, so nothing is copied.
+"""
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from lc_calc.utils.rate_table import RateTable
+
+MAGIC = b'LCRATES1'
+HEADER = struct.Struct('<8sQ')
+DTYPE = np.dtype('<f8')
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def write_rate_book_file(path, snapshots, versions):
+    """
+    Write the snapshots ({(loan_company_id, loan_type_id): {value_type_id: RateTable}}) and their versions
+    (as used by RateBook) to a rate book file. The file is written alongside and then moved into place, so
+    a reader only ever sees a whole file.
+    """
+    index = []
+    blocks = []
+    offsets = {}
+    offset = 0
+    for ((loan_company_id, loan_type_id), tables) in sorted(snapshots.items()):
+        entries = []
+        for (value_type_id, table) in sorted(tables.items()):
+            credit_scores, value_indices, values = table.arrays
+            if table.digest not in offsets:
+                block = np.concatenate([credit_scores, value_indices, values.ravel()]).astype(DTYPE).tobytes()
+                offsets[table.digest] = offset
+                blocks.append(block)
+                offset += len(block)
+            entries.append({'value_type_id': value_type_id,
+                            'offset': offsets[table.digest],
+                            'rows': len(credit_scores),
+                            'columns': len(value_indices)})
+        index.append({'loan_company_id': loan_company_id,
+                      'loan_type_id': loan_type_id,
+                      'version': versions.get((loan_company_id, loan_type_id)),
+                      'tables': entries})
+    index = json.dumps({'snapshots': index}).encode('utf-8')
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.rate_book', delete=False) as rate_book_file:
+        try:
+            rate_book_file.write(HEADER.pack(MAGIC, len(index)))
+            rate_book_file.write(index)
+            rate_book_file.write(b'\0' * (_align(HEADER.size + len(index)) - HEADER.size - len(index)))
+            for block in blocks:
+                rate_book_file.write(block)
+            rate_book_file.flush()
+            os.fsync(rate_book_file.fileno())
+        except Exception:
+            os.unlink(rate_book_file.name)
+            raise
+    os.chmod(rate_book_file.name, 0o644)
+    os.replace(rate_book_file.name, path)
+
+
+class RateBookFile(object):
+    """
+    A rate book file mapped read only.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as rate_book_file:
+            self._mmap = mmap.mmap(rate_book_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a rate book file'.format(path))
+        index = json.loads(self._mmap[HEADER.size:HEADER.size + index_length].decode('utf-8'))
+        self._data_offset = _align(HEADER.size + index_length)
+        self._snapshots = {(snapshot['loan_company_id'], snapshot['loan_type_id']): snapshot
+                           for snapshot in index['snapshots']}
+        self._tables = {}
+
+    def __contains__(self, key):
+        return key in self._snapshots
+
+    def get_version(self, loan_company_id, loan_type_id):
+        return self._snapshots[(loan_company_id, loan_type_id)]['version']
+
+    def get_snapshot(self, loan_company_id, loan_type_id):
+        """
+        Return the tables for (loan_company, loan_type) as a dictionary keyed on value_type_id.
+        """
+        return {entry['value_type_id']: self._get_table(entry['offset'], entry['rows'], entry['columns'])
+                for entry in self._snapshots[(loan_company_id, loan_type_id)]['tables']}
+
+    def _get_table(self, offset, rows, columns):
+        # The tables are keyed on their block, so the snapshots sharing one share the table too
+        try:
+            return self._tables[offset]
+        except KeyError:
+            block = np.frombuffer(self._mmap, dtype=DTYPE, count=rows + columns + rows * columns,
+                                  offset=self._data_offset + offset)
+            table = self._tables[offset] = RateTable.from_arrays(block[:rows],
+                                                                 block[rows:rows + columns],
+                                                                 block[rows + columns:].reshape(rows, columns))
+            return table
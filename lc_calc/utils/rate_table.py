@@ -0,0 +1,523 @@
+"""
+Compiled, in memory versions of the LoanAddition lookup tables.
+
+Each (loan_company, loan_type, value_type) table is a grid of values with the
+credit scores as rows and the value indices as columns. The lookup used by
+LoanCalculation.get_addition is "the first row with credit_score >= x and
+value_index >= y, with x and y clamped to the largest values in the table",
+which on sorted axes is a bisection on each axis. Where the axes are of integers
+(credit scores, years, whole percentages) that are not too far apart, the
+bisection is precomputed for every integer in their range, so that the
+vectorised lookups are an index into those arrays instead. (Single lookups
+stay with bisect on lists, which is quicker in Python than indexing.)
+"""
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+import hashlib
+import os
+import threading
+import time
+import weakref
+
+import numpy as np
+
+MISSING = float('nan')
+MAXIMUM_CREDIT_SCORE = 850
+# The widest integer axis that is given a direct index
+DENSE_AXIS_SPAN = 4096
+
+
+def _dense_axis(axis):
+    """
+    The direct index of a sorted integer axis: the position of the first value >= x for each integer x from the
+    first value of the axis to the last (None if the axis is not suitable).
+    """
+    if (not len(axis) or np.any(axis != np.floor(axis)) or np.any(np.diff(axis) <= 0) or
+            axis[-1] - axis[0] >= DENSE_AXIS_SPAN):
+        return None
+    return np.searchsorted(axis, np.arange(axis[0], axis[-1] + 1))
+
+
+def cells_digest(cells):
+    """
+    A hash of (credit_score, value_index, value) cells in table order, the first of any repeated cell counting.
+    The cells determine the table, so this is the same for any tables that are the same.
+    """
+    cells = np.asarray(cells, dtype='<f8').reshape(-1, 3)
+    if len(cells) > 1:
+        first = np.ones(len(cells), dtype=bool)
+        first[1:] = np.any(cells[1:, :2] != cells[:-1, :2], axis=1)
+        cells = cells[first]
+    return hashlib.sha1(cells.tobytes()).hexdigest()
+
+
+class RateTable(object):
+    """
+    A compiled lookup table.
+    - credit_scores: the sorted, unique credit scores (rows)
+    - value_indices: the sorted, unique value indices (columns)
+    - values: one list of values per credit score, MISSING where the table has no cell
+    These may also be NumPy arrays (see from_arrays).
+    """
+
+    def __init__(self, credit_scores, value_indices, values):
+        self.credit_scores = credit_scores
+        self.value_indices = value_indices
+        self.values = values
+        self._arrays = None
+        self._digest = None
+        self._dense = None
+
+    def __len__(self):
+        return len(self.credit_scores) * len(self.value_indices)
+
+    @classmethod
+    def from_rows(cls, rows, digest=None):
+        """
+        Compile a table from (credit_score, value_index, value) rows, and their cells_digest if it is known.
+        The rows should be ordered as the LoanAddition table is, so the first of any duplicates wins.
+        """
+        cells = {}
+        for credit_score, value_index, value in rows:
+            cells.setdefault((credit_score, value_index), value)
+
+        credit_scores = sorted({credit_score for (credit_score, value_index) in cells})
+        value_indices = sorted({value_index for (credit_score, value_index) in cells})
+        rows_by_score = {credit_score: i for (i, credit_score) in enumerate(credit_scores)}
+        columns_by_index = {value_index: j for (j, value_index) in enumerate(value_indices)}
+
+        values = [[MISSING] * len(value_indices) for _ in credit_scores]
+        for (credit_score, value_index), value in cells.items():
+            values[rows_by_score[credit_score]][columns_by_index[value_index]] = value
+        table = cls(credit_scores, value_indices, values)
+        table._digest = digest
+        return table
+
+    @classmethod
+    def from_arrays(cls, credit_scores, value_indices, grid):
+        """
+        Make a table from NumPy arrays (grid shaped credit scores x value indices), which are used as they are
+        without copying them.
+        """
+        table = cls(credit_scores, value_indices, grid)
+        table._arrays = (credit_scores, value_indices, grid)
+        return table
+
+    def lookup(self, credit_score, value_index):
+        """
+        Return the value for the first cell with credit_score >= credit_score and value_index >= value_index.
+        Indices above the largest in the table are clamped to it.
+        """
+        if not len(self.credit_scores):
+            raise IndexError('The rate table is empty')
+        row = bisect_left(self.credit_scores, min(credit_score, self.credit_scores[-1]))
+        column = bisect_left(self.value_indices, min(value_index, self.value_indices[-1]))
+        value = self.values[row][column]
+        if value != value:
+            # Not a full grid, so look further along in the table ordering
+            return self._scan(row, column)
+        return value
+
+    def _scan(self, row, column):
+        for values in self.values[row:]:
+            for value in values[column:]:
+                if value == value:
+                    return value
+        raise IndexError('No rate table value found')
+
+    @property
+    def arrays(self):
+        """
+        The (credit_scores, value_indices, values) as NumPy arrays (built on first use).
+        """
+        if self._arrays is None:
+            self._arrays = self._make_arrays()
+        return self._arrays
+
+    def _make_arrays(self):
+        return (np.array(self.credit_scores, dtype=float),
+                np.array(self.value_indices, dtype=float),
+                np.array(self.values, dtype=float).reshape(len(self.credit_scores), len(self.value_indices)))
+
+    @property
+    def digest(self):
+        """
+        The cells_digest of the table (the arrays it is worked out from are not kept).
+        """
+        if self._digest is None:
+            credit_scores, value_indices, values = self._arrays or self._make_arrays()
+            rows, columns = np.nonzero(~np.isnan(values))
+            self._digest = cells_digest(np.column_stack((credit_scores[rows], value_indices[columns],
+                                                         values[rows, columns])))
+        return self._digest
+
+    @property
+    def dense(self):
+        """
+        (credit_score_index, value_index_index, grid) if both axes can be directly indexed (else False), where the
+        indices are as _dense_axis and the grid has every missing cell filled as lookup would (NaN if it cannot).
+        Built on first use.
+        """
+        if self._dense is None:
+            credit_score_axis, value_index_axis, grid = self.arrays
+            credit_score_index = _dense_axis(credit_score_axis)
+            value_index_index = _dense_axis(value_index_axis)
+            if credit_score_index is None or value_index_index is None:
+                self._dense = False
+            else:
+                grid = grid.copy()
+                for (row, column) in np.argwhere(np.isnan(grid)):
+                    try:
+                        grid[row, column] = self._scan(row, column)
+                    except IndexError:
+                        pass
+                self._dense = (credit_score_index.astype(np.intp), value_index_index.astype(np.intp), grid)
+        return self._dense
+
+    def validate(self):
+        """
+        Return a list of descriptions of anything that looks wrong with the table.
+        """
+        credit_score_axis, value_index_axis, grid = self.arrays
+        if not len(credit_score_axis):
+            return ['The table is empty']
+        problems = []
+        for (name, axis) in (('credit scores', credit_score_axis), ('value indices', value_index_axis)):
+            if np.any(np.diff(axis) <= 0):
+                problems.append('The {} are not in increasing order'.format(name))
+        # A single row is a table that does not depend on the credit score
+        if len(credit_score_axis) > 1 and credit_score_axis[-1] < MAXIMUM_CREDIT_SCORE:
+            problems.append('The highest credit score is {:g}, so scores up to {} are looked up as {:g}'.format(
+                credit_score_axis[-1], MAXIMUM_CREDIT_SCORE, credit_score_axis[-1]))
+        for (row, column) in np.argwhere(np.isnan(grid)):
+            problems.append('There is no value for credit score {:g} and value index {:g}'.format(
+                credit_score_axis[row], value_index_axis[column]))
+        return problems
+
+    def lookup_many(self, credit_scores, value_indices):
+        """
+        The vectorised version of lookup for arrays of credit scores and value indices.
+        Elements where either index is NaN are NaN in the result.
+        """
+        if not len(self.credit_scores):
+            raise IndexError('The rate table is empty')
+        credit_score_axis, value_index_axis, grid = self.arrays
+        credit_scores, value_indices = np.broadcast_arrays(np.asarray(credit_scores, dtype=float),
+                                                           np.asarray(value_indices, dtype=float))
+        shape = credit_scores.shape
+        credit_scores = credit_scores.ravel()
+        value_indices = value_indices.ravel()
+        unknown = np.isnan(credit_scores) | np.isnan(value_indices)
+        dense = self.dense
+        if dense:
+            (credit_score_index, value_index_index, grid) = dense
+            rows = credit_score_index[(np.clip(np.ceil(np.where(unknown, 0.0, credit_scores)),
+                                               credit_score_axis[0], credit_score_axis[-1]) -
+                                       credit_score_axis[0]).astype(np.intp)]
+            columns = value_index_index[(np.clip(np.ceil(np.where(unknown, 0.0, value_indices)),
+                                                 value_index_axis[0], value_index_axis[-1]) -
+                                         value_index_axis[0]).astype(np.intp)]
+        else:
+            rows = np.searchsorted(credit_score_axis, np.minimum(credit_scores, credit_score_axis[-1]))
+            columns = np.searchsorted(value_index_axis, np.minimum(value_indices, value_index_axis[-1]))
+            rows[unknown] = 0
+            columns[unknown] = 0
+        values = grid[rows, columns]
+        for i in np.flatnonzero(np.isnan(values) & ~unknown):
+            # Not a full grid, so look further along in the table ordering
+            values[i] = self._scan(rows[i], columns[i])
+        values[unknown] = np.nan
+        return values.reshape(shape)
+
+
+EMPTY_RATE_TABLE = RateTable([], [], [])
+
+
+def compile_rows(rows, shared=None):
+    """
+    Compile (value_type_id, credit_score, value_index, value) rows in table order into a dictionary of tables
+    keyed on value_type_id. If shared (a mapping of cells_digest to table) is given, the tables already in it are
+    taken from it instead of being compiled again, and the others are added to it.
+    """
+    value_type_rows = defaultdict(list)
+    for (value_type_id, credit_score, value_index, value) in rows:
+        value_type_rows[value_type_id].append((credit_score, value_index, value))
+    if shared is None:
+        return {value_type_id: RateTable.from_rows(table_rows)
+                for (value_type_id, table_rows) in value_type_rows.items()}
+    tables = {}
+    for (value_type_id, table_rows) in value_type_rows.items():
+        digest = cells_digest(table_rows)
+        table = shared.get(digest)
+        if table is None:
+            table = shared[digest] = RateTable.from_rows(table_rows, digest)
+        tables[value_type_id] = table
+    return tables
+
+
+PricingAddition = namedtuple('PricingAddition', ['value_type_id', 'value_index_method_name', 'value_index', 'table'])
+
+
+class PricingPlan(object):
+    """
+    Everything needed to price a (loan_company, loan_type), resolved once so that pricing is a loop over
+    PricingAdditions with no queries and no dispatch on names:
+    - rate_additions: the additions summed into the rate, in the order they are summed
+    - maximum_term: the maximum term addition (None if there is no maximum term table)
+    Each addition has its value index function and its RateTable.
+    """
+    maximum_term_name = 'Maximum term'
+
+    def __init__(self, rate_additions, maximum_term):
+        self.rate_additions = tuple(rate_additions)
+        self.maximum_term = maximum_term
+        self._digest = None
+
+    @property
+    def digest(self):
+        """
+        A hash of the additions and their tables' contents, the same for plans that price alike.
+        """
+        if self._digest is None:
+            additions = [(addition.value_type_id, addition.value_index_method_name, addition.table.digest)
+                         for addition in self.rate_additions + (self.maximum_term,) if addition is not None]
+            self._digest = hashlib.sha1(repr(additions).encode('utf-8')).hexdigest()
+        return self._digest
+
+    @property
+    def quotable(self):
+        """
+        Whether the plan can price anything: it has a maximum term and none of its tables is empty.
+        """
+        return self.maximum_term is not None and all(len(addition.table)
+                                                     for addition in self.rate_additions + (self.maximum_term,))
+
+    @classmethod
+    def from_value_types(cls, value_types, tables, value_index_functions):
+        """
+        Make the plan from the LoanAdditionTypes (in id order), the snapshot of their tables keyed on
+        value_type_id and the value index functions keyed on value_index_method_name.
+        """
+        def addition(value_type):
+            return PricingAddition(value_type.pk,
+                                   value_type.value_index_method_name,
+                                   value_index_functions[value_type.value_index_method_name],
+                                   tables.get(value_type.pk, EMPTY_RATE_TABLE))
+
+        rate_additions = [addition(value_type) for value_type in value_types if value_type.sum_in_rate_calculation]
+        maximum_term = next((addition(value_type) for value_type in value_types
+                             if value_type.name == cls.maximum_term_name), None)
+        return cls(rate_additions, maximum_term)
+
+
+class RateBook(object):
+    """
+    A per process cache of compiled rate tables.
+
+    The tables are compiled one (loan_company, loan_type) snapshot at a time, using
+    loader(loan_company_id, loan_type_id) which must return a dictionary of RateTables keyed on value_type_id
+    (see compile_rows).
+
+    If a cache shared between the processes is supplied, every snapshot is tagged with a version kept in it.
+    bump() changes the version of a snapshot and a generation counter covering all of them, and sync() (called
+    once per request) compares the generation with the one last seen to find and drop stale snapshots.
+    A bump made inside a transaction goes out before the transaction commits, so the changes are bumped again
+    after it, within after_commit().
+
+    If a path is supplied, write_file() compiles the snapshots into a rate book file there, which sync() maps
+    (again when the file is replaced). The file's snapshots are used instead of the loader for as long as
+    their versions are current, so the processes share one copy of the tables that have not changed since.
+    A version missing from the cache (never set, or evicted) is unknown, so the file is not used for it.
+
+    Tables are shared by content: identical tables in different snapshots (common, as many are constant or
+    repeated across loan types) are one RateTable in memory and one block in the file. A loader that compiles
+    its rows with compile_rows() here has the repeats found from their rows, without compiling them.
+
+    If a planner is supplied, get_plan() also keeps a PricingPlan for each snapshot, made by
+    planner(loan_company_id, loan_type_id, tables, value_types) where value_types are the LoanAdditionTypes
+    if the caller already has them (else None). A plan is remade whenever its snapshot is.
+    """
+    generation_key = 'lc_calc.rate_book.generation'
+
+    def __init__(self, loader, cache=None, path=None, planner=None):
+        self.loader = loader
+        self.planner = planner
+        self.cache = cache
+        self.path = path
+        self.generation = None
+        self.file = None
+        self._file_id = None
+        self._snapshots = {}
+        self._versions = {}
+        self._tables = weakref.WeakValueDictionary()
+        self._plans = {}
+        self._pending = threading.local()
+
+    @staticmethod
+    def version_key(loan_company_id, loan_type_id):
+        return 'lc_calc.rate_book.{}.{}'.format(loan_company_id, loan_type_id)
+
+    def compile(self, loan_company_id, loan_type_id):
+        return self.loader(loan_company_id, loan_type_id)
+
+    def compile_rows(self, rows):
+        """
+        compile_rows, taking the tables identical to ones already in memory from those (for loaders to use).
+        """
+        return compile_rows(rows, self._tables)
+
+    def get_snapshot(self, loan_company_id, loan_type_id):
+        """
+        Return the tables for (loan_company, loan_type) as a dictionary keyed on value_type_id.
+        """
+        key = (loan_company_id, loan_type_id)
+        try:
+            return self._snapshots[key]
+        except KeyError:
+            version = None
+            if self.cache is not None:
+                # Read the version first so that a change made while compiling is picked up by the next sync
+                version = self._versions[key] = self.cache.get(self.version_key(*key))
+            if (self.file is not None and version is not None and key in self.file and
+                    self.file.get_version(*key) == version):
+                snapshot = self.file.get_snapshot(*key)
+            else:
+                snapshot = {value_type_id: self._tables.setdefault(table.digest, table)
+                            for (value_type_id, table) in self.compile(loan_company_id, loan_type_id).items()}
+            self._snapshots[key] = snapshot
+            return snapshot
+
+    def get_table(self, loan_company_id, loan_type_id, value_type_id):
+        return self.get_snapshot(loan_company_id, loan_type_id).get(value_type_id, EMPTY_RATE_TABLE)
+
+    def get_plan(self, loan_company_id, loan_type_id, value_types=None):
+        """
+        Return the PricingPlan for (loan_company, loan_type).
+        """
+        key = (loan_company_id, loan_type_id)
+        snapshot = self.get_snapshot(loan_company_id, loan_type_id)
+        try:
+            plan_snapshot, plan = self._plans[key]
+            if plan_snapshot is snapshot:
+                return plan
+        except KeyError:
+            pass
+        plan = self.planner(loan_company_id, loan_type_id, snapshot, value_types)
+        self._plans[key] = (snapshot, plan)
+        return plan
+
+    def get_version(self, loan_company_id, loan_type_id):
+        """
+        The version of the snapshot in use for (loan_company, loan_type) (None if unknown).
+        """
+        self.get_snapshot(loan_company_id, loan_type_id)
+        return self._versions.get((loan_company_id, loan_type_id))
+
+    def invalidate(self, loan_company_id, loan_type_id):
+        """
+        Forget a snapshot so that it is recompiled when next used.
+        """
+        key = (loan_company_id, loan_type_id)
+        self._snapshots.pop(key, None)
+        self._versions.pop(key, None)
+        self._plans.pop(key, None)
+
+    def bump(self, loan_company_id, loan_type_id):
+        """
+        Record that the tables for (loan_company, loan_type) have changed, in this and every other process.
+        """
+        self.invalidate(loan_company_id, loan_type_id)
+        if self.cache is not None:
+            for key in (self.version_key(loan_company_id, loan_type_id), self.generation_key):
+                try:
+                    self.cache.incr(key)
+                except ValueError:
+                    # Not there (or evicted), so start again from a value no process can have seen
+                    self.cache.set(key, self.new_version(), None)
+        pending = getattr(self._pending, 'keys', None)
+        if pending is not None:
+            pending.add((loan_company_id, loan_type_id))
+
+    @contextmanager
+    def after_commit(self):
+        """
+        Bump again, as the block exits, whatever was bumped inside it (in this thread). Wrapped around a
+        transaction, this makes the processes that recompiled the old rows before it committed compile again.
+        """
+        if getattr(self._pending, 'keys', None) is not None:
+            yield
+            return
+        self._pending.keys = keys = set()
+        try:
+            yield
+        finally:
+            self._pending.keys = None
+            for key in keys:
+                self.bump(*key)
+
+    @staticmethod
+    def new_version():
+        return int(time.time() * 1000000)
+
+    def seed_version(self, loan_company_id, loan_type_id):
+        """
+        The version of (loan_company, loan_type) in the cache, first setting one if there is none.
+        """
+        key = self.version_key(loan_company_id, loan_type_id)
+        self.cache.add(key, self.new_version(), None)
+        return self.cache.get(key)
+
+    def sync(self):
+        """
+        Drop any snapshots that have been changed by another process since the last sync.
+        """
+        if self.path is not None:
+            self.sync_file()
+        if self.cache is None:
+            return
+        generation = self.cache.get(self.generation_key)
+        if generation == self.generation:
+            return
+        self.generation = generation
+        if self._snapshots:
+            keys = {self.version_key(*key): key for key in self._snapshots}
+            versions = self.cache.get_many(list(keys))
+            for (version_key, key) in keys.items():
+                if versions.get(version_key) != self._versions.get(key):
+                    self.invalidate(*key)
+
+    def sync_file(self):
+        """
+        Map the rate book file if it has been replaced (or unmap it if it has gone).
+        """
+        try:
+            stat = os.stat(self.path)
+            file_id = (stat.st_ino, stat.st_mtime)
+        except OSError:
+            file_id = None
+        if file_id != self._file_id:
+            from lc_calc.utils.rate_book_file import RateBookFile
+            self._file_id = file_id
+            # The old mapping is closed once the last of its tables has gone
+            self.file = RateBookFile(self.path) if file_id is not None else None
+            self.clear()
+
+    def write_file(self, keys):
+        """
+        Compile the snapshots of the (loan_company_id, loan_type_id) keys and write them to the rate book file.
+        """
+        from lc_calc.utils.rate_book_file import write_rate_book_file
+        snapshots = {}
+        versions = {}
+        for key in keys:
+            # Read (or set) the version first so that a change made while compiling is picked up by the next sync
+            if self.cache is not None:
+                versions[key] = self.seed_version(*key)
+            snapshots[key] = self.compile(*key)
+        write_rate_book_file(self.path, snapshots, versions)
+
+    def clear(self):
+        self._snapshots.clear()
+        self._versions.clear()
+        self._plans.clear()
@@ -0,0 +1,146 @@
+"""
+A durable write-behind spool.
+
+Records (anything JSON can encode) are added to a SQLite file as they come, which is quick and survives a restart,
+and a background thread in each process hands them to a writer in batches, oldest first, deleting them once the
+writer has returned. A flush claims its batch in a short transaction and runs the writer outside it, so adding
+records is never held up by a slow writer, and the processes sharing a spool each flush the batches they claimed.
+Each record is written once, or again if its batch was claimed by a process that died or took longer than
+claim_timeout (the writer's work is not undone), and a batch the writer fails on goes back to be flushed again.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """
+    A spool in the SQLite file at path, flushed by writer(records).
+    - batch_size: the most records given to the writer at once (a flush is started early once this many are waiting)
+    - flush_interval: the seconds between flushes (None for no background flushing, leaving it to flush_all())
+    - max_pending: put() refuses records while this many are waiting, so the caller can write them itself
+    - encoder: the JSONEncoder class for the records
+    - cleanup: called by the background flusher after each round of flushing (to close connections, say)
+    - claim_timeout: the seconds after which a claimed batch that is still in the spool is flushed again
+    """
+
+    def __init__(self, path, writer, batch_size=500, flush_interval=5.0, max_pending=100000, encoder=None,
+                 cleanup=None, claim_timeout=600):
+        self.path = path
+        self.writer = writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.encoder = encoder
+        self.cleanup = cleanup
+        self.claim_timeout = claim_timeout
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def connect(self):
+        """
+        The SQLite connection of this thread (a process forked from this one makes its own).
+        """
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS spool '
+                               '(id INTEGER PRIMARY KEY AUTOINCREMENT, record TEXT, claim TEXT, claimed_at REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS spool_claim ON spool (claim)')
+            self._local.connection = connection
+            self._local.pid = pid
+        return self._local.connection
+
+    def pending(self):
+        """
+        The number of records waiting (about, as ids may have been skipped).
+        """
+        first, last = self.connect().execute('SELECT min(id), max(id) FROM spool').fetchone()
+        return 0 if first is None else last - first + 1
+
+    def put(self, record):
+        """
+        Add a record, returning False (and not adding it) if the spool is full.
+        """
+        pending = self.pending()
+        if pending >= self.max_pending:
+            self._wakeup.set()
+            return False
+        self.connect().execute('INSERT INTO spool (record) VALUES (?)', (json.dumps(record, cls=self.encoder),))
+        self.start()
+        if pending + 1 >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        """
+        Write a batch of records, returning how many there were.
+        """
+        connection = self.connect()
+        claim = uuid.uuid4().hex
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('UPDATE spool SET claim = ?, claimed_at = ? WHERE id IN '
+                               '(SELECT id FROM spool WHERE claim IS NULL OR claimed_at < ? ORDER BY id LIMIT ?)',
+                               (claim, now, now - self.claim_timeout, self.batch_size))
+            records = [json.loads(record) for (record,) in
+                       connection.execute('SELECT record FROM spool WHERE claim = ? ORDER BY id', (claim,))]
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        if not records:
+            return 0
+        try:
+            self.writer(records)
+        except Exception:
+            connection.execute('UPDATE spool SET claim = NULL, claimed_at = NULL WHERE claim = ?', (claim,))
+            raise
+        connection.execute('DELETE FROM spool WHERE claim = ?', (claim,))
+        return len(records)
+
+    def flush_all(self):
+        """
+        Write every waiting record, returning how many there were.
+        """
+        count = 0
+        while True:
+            written = self.flush()
+            count += written
+            if written < self.batch_size:
+                return count
+
+    def start(self):
+        """
+        Start the background flusher of this process, if it is not running.
+        """
+        if self.flush_interval is None or (self._flusher is not None and self._flusher.is_alive()):
+            return
+        with self._lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self.run, name='spool flusher')
+                self._flusher.daemon = True
+                self._flusher.start()
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush_all()
+            except Exception:
+                # The records stay in the spool for the next flush
+                logger.exception('Cannot flush the spool %s', self.path)
+            finally:
+                if self.cleanup is not None:
+                    self.cleanup()
@@ -1,21 +1,36 @@
+import csv
+import json
+from itertools import chain
+
+from django.views.generic import View
 from django.views.generic.edit import FormView, CreateView
-from django.shortcuts import get_object_or_404, redirect
+from django.shortcuts import redirect
 from django.core.urlresolvers import reverse
 from django.contrib import messages
+from django.core.exceptions import ValidationError
+from django.forms.models import model_to_dict
+from django.http import HttpResponse, StreamingHttpResponse, Http404
 
 import lc_calc.models as lcmodels
-from lc_calc.forms import LoanCalculationForm
+from lc_calc.forms import LoanCalculationForm, LoanComparisonForm
+from lc_calc.quotes import quote_grid, maximum_loan_amounts, compare_loan_companies
+from lc_calc.utils.money import MoneyJSONEncoder
 
 
 class LoanCompanyMixin(object):
     """
-    Provides view with calculation and template with loan_company and calculation (if present)
+    Provides view with calculation and template with loan_company and calculation (if present).
+    Each is looked up once per request.
     """
     def get_loan_company(self):
-        # Add the loan company
-        return get_object_or_404(
-            lcmodels.LoanCompany,
-            slug=self.kwargs['loan_company_slug'])
+        try:
+            return self.loan_company
+        except AttributeError:
+            try:
+                self.loan_company = lcmodels.LoanCompany.get_by_slug(self.kwargs['loan_company_slug'])
+            except lcmodels.LoanCompany.DoesNotExist:
+                raise Http404
+        return self.loan_company
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -37,24 +52,62 @@ class LoanCompanyMixin(object):
             return self.calculation
         except AttributeError:
             calculation_id = self.request.session.get('calculation_id', None)
-            if calculation_id is None:
-                self.calculation = None
+            record = self.request.session.get('calculation', None)
+            loan_company = self.get_loan_company()
+            if record is not None:
+                calculation = lcmodels.LoanCalculation.from_record(json.loads(record))
+                self.calculation = calculation if calculation.loan_company_id == loan_company.pk else None
+            elif calculation_id is not None:
+                self.calculation = lcmodels.LoanCalculation.objects.select_related('loan_type').filter(
+                    id=calculation_id, loan_company=loan_company).first()
             else:
-                calculation = lcmodels.LoanCalculation.objects.get(id=calculation_id)
-                if calculation.loan_company == self.get_loan_company():
-                    self.calculation = calculation
-                else:
-                    self.calculation = None
+                self.calculation = None
+            if self.calculation is not None:
+                self.calculation.loan_company = loan_company
         return self.calculation
 
     def put_calculation(self, calculation):
         """
-        Record calculation in the session and on self
+        Record calculation in the session and on self.
+        A spooled calculation has no id yet, so its values are kept instead.
         """
-        self.request.session['calculation_id'] = calculation.id
+        if calculation.id is None:
+            self.request.session['calculation'] = json.dumps(calculation.get_record(), cls=MoneyJSONEncoder)
+            self.request.session.pop('calculation_id', None)
+        else:
+            self.request.session['calculation_id'] = calculation.id
+            self.request.session.pop('calculation', None)
+        self.calculation = calculation
         self.request.session.set_expiry(3600)  # remember it for an hour
 
 
+class JSONResponseMixin(object):
+    """
+    Renders a dictionary as a JSON response.
+    """
+    def render_to_json_response(self, data, status=200):
+        return HttpResponse(json.dumps(data, cls=MoneyJSONEncoder),
+                            content_type='application/json',
+                            status=status)
+
+    def render_to_json_errors(self, errors):
+        errors = {name: [str(error) for error in field_errors] for (name, field_errors) in errors.items()}
+        return self.render_to_json_response({'errors': errors}, status=400)
+
+
+class Echo(object):
+    """
+    A file like object that returns what is written to it, so that csv rows can be streamed.
+    """
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    return (writer.writerow(row) for row in rows)
+
+
 class CalculationView(LoanCompanyMixin, FormView):
     template_name = "lc_calc/calculation.html"
     form_class = LoanCalculationForm
@@ -73,8 +126,9 @@ class CalculationView(LoanCompanyMixin, FormView):
         return kwargs
 
     def form_valid(self, form):
-        form.save()
-        self.put_calculation(form.instance)
+        calculation = form.save(commit=False)
+        calculation.record()
+        self.put_calculation(calculation)
         return redirect("calculation", **self.kwargs)
 
 
@@ -91,5 +145,252 @@ class LoanCompanyMessageView(LoanCompanyMixin, CreateView):
         lcm.loan_company = self.get_loan_company()
         calculation = self.get_calculation()
         if calculation:
+            if calculation.id is None:
+                # Still in the spool, so save it now to refer to it
+                calculation.save()
+                self.put_calculation(calculation)
             lcm.loan_calculation = calculation
-        return super().form_valid(form)
\ No newline at end of file
+        return super().form_valid(form)
+
+
+class QuoteView(LoanCompanyMixin, JSONResponseMixin, View):
+    """
+    Calculate a quote from the calculation form fields in the query string and return it as JSON.
+    Nothing is saved and the session is not used; missing fields take the LoanCalculation defaults.
+    A disqualified quote has the fields that depend on the rate set to null.
+    """
+    quote_fields = ['rate',
+                    'maximum_term',
+                    'monthly_term',
+                    'monthly_payment',
+                    'apr',
+                    'qualified',
+                    'current_loan_estimated_remaining_term',
+                    'estimated_monthly_savings',
+                    'estimated_yearly_savings',
+                    'current_loan_remaining_interest',
+                    'loan_interest',
+                    'interest_savings']
+    disqualified_fields = ['rate',
+                           'monthly_payment',
+                           'apr',
+                           'estimated_monthly_savings',
+                           'estimated_yearly_savings',
+                           'loan_interest',
+                           'interest_savings']
+    # The value indices divide by these
+    divisor_fields = ['estimated_collateral_value',
+                      'estimated_monthly_income']
+
+    def get_form_data(self, loan_company):
+        data = model_to_dict(lcmodels.LoanCalculation(), fields=LoanCalculationForm._meta.fields)
+        data.update(self.request.GET.items())
+        data['loan_company_id'] = loan_company.id
+        return data
+
+    def render_to_json_unquotable(self):
+        return self.render_to_json_errors({'loan_type': ['No quotes are available for this loan type']})
+
+    def get(self, request, *args, **kwargs):
+        loan_company = self.get_loan_company()
+        form = LoanCalculationForm(data=self.get_form_data(loan_company), loan_company=loan_company)
+        if not form.is_valid():
+            return self.render_to_json_errors(form.errors)
+
+        errors = {name: ['Must be greater than zero'] for name in self.divisor_fields
+                  if not form.cleaned_data.get(name)}
+        if errors:
+            return self.render_to_json_errors(errors)
+
+        calculation = form.instance
+        calculation.loan_company = loan_company
+        try:
+            calculation.calculate()
+        except lcmodels.LoanAdditionType.DoesNotExist:
+            return self.render_to_json_unquotable()
+        data = {name: getattr(calculation, name) for name in self.quote_fields}
+        if calculation.disqualified:
+            data.update((name, None) for name in self.disqualified_fields)
+        return self.render_to_json_response(data)
+
+
+class QuoteGridView(QuoteView):
+    """
+    Calculate quotes for every combination of the loan_amount and monthly_term values in the query string
+    (each may be given several times) and return them as JSON lists of rows, one row per loan amount.
+    The disqualified quotes have null for the fields that depend on the rate.
+    """
+    max_grid_length = 60
+    grid_fields = ['rate',
+                   'maximum_term',
+                   'monthly_term',
+                   'monthly_payment',
+                   'apr']
+
+    def clean_grid_values(self, form, name):
+        values = self.request.GET.getlist(name)
+        if not values or len(values) > self.max_grid_length:
+            raise ValidationError('Between 1 and {} values are needed'.format(self.max_grid_length))
+        return [form.fields[name].clean(value) for value in values]
+
+    def get(self, request, *args, **kwargs):
+        loan_company = self.get_loan_company()
+        form = LoanCalculationForm(data=self.get_form_data(loan_company), loan_company=loan_company)
+        if not form.is_valid():
+            return self.render_to_json_errors(form.errors)
+
+        grid_values = {}
+        errors = {}
+        for name in ('loan_amount', 'monthly_term'):
+            try:
+                grid_values[name] = self.clean_grid_values(form, name)
+            except ValidationError as e:
+                errors[name] = e.messages
+        if errors:
+            return self.render_to_json_errors(errors)
+
+        profile = form.cleaned_data
+        try:
+            quotes = quote_grid(loan_company, profile['loan_type'],
+                                grid_values['loan_amount'],
+                                grid_values['monthly_term'],
+                                estimated_credit_score=profile['estimated_credit_score'],
+                                estimated_collateral_value=profile['estimated_collateral_value'],
+                                estimated_monthly_income=profile['estimated_monthly_income'],
+                                estimated_monthly_expenses=profile['estimated_monthly_expenses'],
+                                estimated_year_of_collateral=profile['estimated_year_of_collateral'])
+        except lcmodels.LoanAdditionType.DoesNotExist:
+            return self.render_to_json_unquotable()
+
+        data = {'loan_amounts': grid_values['loan_amount'],
+                'monthly_terms': grid_values['monthly_term']}
+        rates = quotes['rate'].tolist()
+        for name in self.grid_fields:
+            # NaN (disqualified or not calculable) is not valid JSON
+            disqualifies = name in self.disqualified_fields
+            data[name] = [[None if value != value or (disqualifies and rate < 0) else value
+                           for (value, rate) in zip(row, rate_row)]
+                          for (row, rate_row) in zip(quotes[name].tolist(), rates)]
+        return self.render_to_json_response(data)
+
+
+class AffordabilityView(QuoteGridView):
+    """
+    Find the largest loan amount whose monthly payment is within the monthly_payment in the query string, for each
+    of the monthly_term values (which may be given several times), and return the quotes as JSON lists.
+    The monthly_payment asked for is returned as budget and the payments of the quotes as monthly_payments.
+    """
+    grid_fields = ['loan_amount'] + QuoteGridView.grid_fields
+
+    def get(self, request, *args, **kwargs):
+        loan_company = self.get_loan_company()
+        form = LoanCalculationForm(data=self.get_form_data(loan_company), loan_company=loan_company)
+        # The loan amount is what we are looking for, and its field validates the payment
+        currency_field = form.fields.pop('loan_amount')
+        if not form.is_valid():
+            return self.render_to_json_errors(form.errors)
+
+        errors = {}
+        try:
+            monthly_payment = currency_field.clean(request.GET.get('monthly_payment'))
+            if monthly_payment <= 0:
+                raise ValidationError('Must be greater than zero')
+        except ValidationError as e:
+            errors['monthly_payment'] = e.messages
+        try:
+            monthly_terms = self.clean_grid_values(form, 'monthly_term')
+        except ValidationError as e:
+            errors['monthly_term'] = e.messages
+        if errors:
+            return self.render_to_json_errors(errors)
+
+        profile = form.cleaned_data
+        try:
+            quotes = maximum_loan_amounts(loan_company, profile['loan_type'],
+                                          float(monthly_payment),
+                                          monthly_terms,
+                                          estimated_credit_score=profile['estimated_credit_score'],
+                                          estimated_collateral_value=profile['estimated_collateral_value'],
+                                          estimated_monthly_income=profile['estimated_monthly_income'],
+                                          estimated_monthly_expenses=profile['estimated_monthly_expenses'],
+                                          estimated_year_of_collateral=profile['estimated_year_of_collateral'])
+        except lcmodels.LoanAdditionType.DoesNotExist:
+            return self.render_to_json_unquotable()
+
+        data = {'budget': monthly_payment,
+                'monthly_terms': monthly_terms}
+        for name in self.grid_fields:
+            key = 'monthly_payments' if name == 'monthly_payment' else name
+            data[key] = [None if value != value else value for value in quotes[name].tolist()]
+        return self.render_to_json_response(data)
+
+
+class LoanComparisonView(JSONResponseMixin, View):
+    """
+    Quote the profile in the query string at every loan company offering its loan_type and return the quotes as a
+    JSON list ranked by order_by (monthly_payment or total_interest). Nothing is saved.
+    The disqualified quotes have null for the fields that depend on the rate.
+    """
+    quote_fields = ['rate',
+                    'maximum_term',
+                    'monthly_term',
+                    'monthly_payment',
+                    'apr',
+                    'total_interest']
+    disqualified_fields = ['rate',
+                           'monthly_payment',
+                           'apr',
+                           'total_interest']
+
+    def get_form_data(self):
+        data = model_to_dict(lcmodels.LoanCalculation(), fields=LoanComparisonForm._meta.fields)
+        data.update(self.request.GET.items())
+        return data
+
+    def get(self, request, *args, **kwargs):
+        form = LoanComparisonForm(data=self.get_form_data())
+        if not form.is_valid():
+            return self.render_to_json_errors(form.errors)
+
+        profile = form.cleaned_data
+        quotes = compare_loan_companies(profile['loan_type'],
+                                        profile['loan_amount'],
+                                        profile['monthly_term'],
+                                        estimated_credit_score=profile['estimated_credit_score'],
+                                        estimated_collateral_value=profile['estimated_collateral_value'],
+                                        estimated_monthly_income=profile['estimated_monthly_income'],
+                                        estimated_monthly_expenses=profile['estimated_monthly_expenses'],
+                                        estimated_year_of_collateral=profile['estimated_year_of_collateral'],
+                                        order_by=profile['order_by'] or 'monthly_payment')
+
+        results = []
+        for quote in quotes:
+            qualified = quote['rate'] >= 0
+            result = {'loan_company': quote['loan_company'].title,
+                      'loan_company_slug': quote['loan_company'].slug,
+                      'qualified': qualified}
+            for name in self.quote_fields:
+                value = quote[name]
+                # NaN (disqualified or not calculable) is not valid JSON
+                if value != value or (not qualified and name in self.disqualified_fields):
+                    value = None
+                result[name] = value
+            results.append(result)
+        return self.render_to_json_response({'loan_type': profile['loan_type'].name, 'quotes': results})
+
+
+class AmortizationScheduleView(LoanCompanyMixin, View):
+    """
+    Stream the payment schedule of the session's calculation as a csv file.
+    """
+    def get(self, request, *args, **kwargs):
+        calculation = self.get_calculation()
+        if calculation is None:
+            raise Http404
+
+        header = [('Month', 'Payment', 'Interest', 'Principal', 'Balance')]
+        response = StreamingHttpResponse(stream_csv(chain(header, calculation.amortization_schedule())),
+                                         content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="payment_schedule_{}.csv"'.format(
+            calculation.id or 'new')
+        return response
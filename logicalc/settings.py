@@ -288,6 +288,7 @@ MIDDLEWARE_CLASSES = (
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "mezzanine.core.request.CurrentRequestMiddleware",
+    "lc_calc.middleware.RateBookMiddleware",
     "mezzanine.core.middleware.RedirectFallbackMiddleware",
     "mezzanine.core.middleware.TemplateForDeviceMiddleware",
     "mezzanine.core.middleware.TemplateForHostMiddleware",
@@ -367,6 +368,21 @@ GUNICORN_BIND = "127.0.0.1:8000"
 
 DEFAULT_MONTHLY_EXPENSES = 1000.0
 DEFAULT_MONTHLY_INCOME = 5000.0
+# Origination fees (in dollars) financed with a loan, used for the APR
+DEFAULT_ORIGINATION_FEE = 0.0
+# The compiled rate book file mapped by every worker (see the compile_rate_book command), None to not use one
+RATE_BOOK_FILE = None
+# Write-behind of the LoanCalculation records: the SQLite spool file they are kept in until they are saved in the
+# background, a batch at a time, or None to save each calculation as it is made
+LOAN_CALCULATION_SPOOL = None
+LOAN_CALCULATION_SPOOL_BATCH_SIZE = 500
+# The seconds between flushes, or None to leave them to the flush_calculation_spool command
+LOAN_CALCULATION_SPOOL_FLUSH_INTERVAL = 5.0
+# While this many calculations are waiting, more are saved as they are made
+LOAN_CALCULATION_SPOOL_MAX_PENDING = 100000
+# The seconds for which a saved LoanCalculation is reused when the same values are calculated again, rather than
+# saving another, or None to always save them
+LOAN_CALCULATION_REUSE_WINDOW = 3600
 
 ##################
 # LOCAL SETTINGS #